@@ -0,0 +1,178 @@
+# coding: utf-8
+# json编解码, 有orjson/ujson时使用更快的库，没有的话使用标准库
+import os, sys
+import json
+import time
+import logging
+from zbase3 import _json_default_trans
+
+log = logging.getLogger()
+
+# 当前使用的json库名称
+name = 'json'
+
+
+def _std_dumps(obj):
+    return json.dumps(obj, default=_json_default_trans, separators=(',', ':')).encode('utf-8')
+
+def _std_loads(s):
+    return json.loads(s)
+
+
+_dumps = _std_dumps
+_loads = _std_loads
+
+
+def _orjson_codec():
+    import orjson
+
+    # datetime交给_json_default_trans处理, 保持和标准库一样的格式; dict的key可以不是字符串
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps(obj):
+        try:
+            return orjson.dumps(obj, default=_json_default_trans, option=option)
+        except TypeError:
+            # 超过64位的整数等orjson不支持的情况
+            return _std_dumps(obj)
+
+    return dumps, orjson.loads
+
+
+def _ujson_codec():
+    import ujson
+
+    def dumps(obj):
+        try:
+            return ujson.dumps(obj, default=_json_default_trans, ensure_ascii=False,
+                    escape_forward_slashes=False).encode('utf-8')
+        except (TypeError, OverflowError):
+            return _std_dumps(obj)
+
+    return dumps, ujson.loads
+
+
+CODECS = {
+    'json': lambda: (_std_dumps, _std_loads),
+    'orjson': _orjson_codec,
+    'ujson': _ujson_codec,
+}
+
+
+def install(names=('orjson', 'ujson')):
+    '''按顺序选择第一个能用的json库, names为空或者都不能用时使用标准库'''
+    global _dumps, _loads, name
+    if isinstance(names, str):
+        names = [names]
+
+    for n in names or []:
+        try:
+            _dumps, _loads = CODECS[n]()
+            name = n
+            return name
+        except ImportError:
+            continue
+
+    _dumps, _loads, name = _std_dumps, _std_loads, 'json'
+    return name
+
+
+def dumps(obj):
+    '''编码为json, 返回bytes'''
+    return _dumps(obj)
+
+def dumps_str(obj):
+    '''编码为json, 返回str'''
+    return _dumps(obj).decode('utf-8')
+
+def loads(s):
+    '''解码json, s可以是bytes或者str'''
+    return _loads(s)
+
+
+# msgpack 编解码，用于二进制的rpc协议, 支持bytes类型
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+def msgpack_dumps(obj):
+    return msgpack.packb(obj, use_bin_type=True, default=_json_default_trans)
+
+def msgpack_loads(s):
+    return msgpack.unpackb(s, raw=False, strict_map_key=False)
+
+
+# 环境变量 ZBASE3_JSON=json 可以强制使用标准库
+if os.environ.get('ZBASE3_JSON'):
+    install(os.environ['ZBASE3_JSON'].split(','))
+else:
+    install()
+
+
+def test_codec():
+    import datetime, decimal
+    obj = {'a': 1, 'b': '中文', 'c': [1.5, None, True], 'd': datetime.datetime(2020, 1, 2, 3, 4, 5),
+           'e': datetime.date(2020, 1, 2), 'f': decimal.Decimal('1.10'), 1: 'int key'}
+    for n in [None, 'orjson', 'ujson']:
+        if install(n) != (n or 'json'):
+            print('skip', n)
+            continue
+        s = dumps(obj)
+        assert isinstance(s, bytes)
+        x = loads(s)
+        assert x['d'] == '2020-01-02 03:04:05' and x['e'] == '2020-01-02' and x['f'] == '1.10'
+        assert x['1'] == 'int key' and x['b'] == '中文'
+        assert loads(s.decode('utf-8')) == x
+        assert loads(dumps(2**70)) == 2**70
+        print(name, 'ok')
+    install()
+
+    if msgpack:
+        obj[2] = b'\x00\xff'
+        x = msgpack_loads(msgpack_dumps(obj))
+        assert x[2] == b'\x00\xff' and x['d'] == '2020-01-02 03:04:05' and x[1] == 'int key'
+        print('msgpack ok')
+
+
+def test_perf(n=1000):
+    '''对比标准库和当前json库编解码1KB, 100KB数据的耗时, 单位微秒'''
+    row = {'id': 1234567, 'name': 'zbase3测试', 'amt': 100.25, 'status': 1, 'tags': ['a', 'b', 'c'],
+           'ctime': '2020-01-02 03:04:05', 'memo': 'x' * 40}
+    payloads = {
+        '1KB': [dict(row, id=i) for i in range(5)],
+        '100KB': [dict(row, id=i) for i in range(500)],
+    }
+    for n_ in [None, 'orjson', 'ujson']:
+        if install(n_) != (n_ or 'json'):
+            continue
+        for k, v in payloads.items():
+            s = dumps(v)
+            t = time.time()
+            for i in range(n):
+                dumps(v)
+            t1 = time.time()
+            for i in range(n):
+                loads(s)
+            t2 = time.time()
+            print('%-7s %-5s size=%-6d dumps=%.1f loads=%.1f' % (name, k, len(s),
+                (t1 - t) / n * 1000000, (t2 - t1) / n * 1000000))
+    install()
+
+    if msgpack:
+        for k, v in payloads.items():
+            s = msgpack_dumps(v)
+            t = time.time()
+            for i in range(n):
+                msgpack_dumps(v)
+            t1 = time.time()
+            for i in range(n):
+                msgpack_loads(s)
+            t2 = time.time()
+            print('%-7s %-5s size=%-6d dumps=%.1f loads=%.1f' % ('msgpack', k, len(s),
+                (t1 - t) / n * 1000000, (t2 - t1) / n * 1000000))
+
+
+if __name__ == '__main__':
+    test_codec()
+    test_perf()
@@ -41,92 +41,177 @@ import copy
 import json
 import re
 import traceback
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from zbase3.base import pager, dbpool
 from contextlib import contextmanager
 log = logging.getLogger()
 
+# 跨分表查询时同时执行的查询数
+SCATTER_CONCURRENCY = 8
+
 class ShardingError (Exception):
     pass
 
-class ShardingConnProxy:
-    def __init__(self, manager, name):
-        self._mg = manager
-        self._name = name
-        self._info = manager._dbinfo.get(name)
-        self._conn = {}
-        self._last_conn = None
 
-    def _route(self, table):
-        '''根据表名返回对应的数据库名'''
-        if not self._info:
-            return None
-
-        dbs = self._info.get('db')
-        if not dbs:
+def month_tables(prefix, start, end):
+    '''按月拆分的表名列表, start/end 为 YYYYMM 格式'''
+    y, m = divmod(int(start), 100)
+    ret = []
+    while y * 100 + m <= int(end):
+        ret.append('%s_%d%02d' % (prefix, y, m))
+        y, m = (y + 1, 1) if m == 12 else (y, m + 1)
+    return ret
+
+def hash_tables(prefix, count):
+    '''按hash拆分的表名列表'''
+    return ['%s_%d' % (prefix, i) for i in range(count)]
+
+def parse_order(order):
+    '''"a desc, b" 转换为 [('a', True), ('b', False)], True表示倒序.
+    结果行里的字段名不带表名, t.a 按 a 排序'''
+    ret = []
+    for x in order.split(','):
+        p = x.split()
+        ret.append((p[0].split('.')[-1].strip('`'), len(p) > 1 and p[1].lower() == 'desc'))
+    return ret
+
+def sort_rows(rows, order):
+    '''按多个字段排序, NULL排在最小'''
+    for name, desc in reversed(order):
+        rows.sort(key=lambda r: (r[name] is not None, r[name]), reverse=desc)
+    return rows
+
+# sql语句里的表名
+TABLE_RE = re.compile(r'\b(?:from|into|update)\s+`?(\w+)', re.I)
+# 每个逻辑库缓存的表名路由结果数
+ROUTE_MEMO_SIZE = 10000
+
+
+def month_add(month, n):
+    '''YYYYMM 格式的月份加上n个月'''
+    y, m = divmod(month // 100 * 12 + month % 100 - 1 + n, 12)
+    return y * 100 + m + 1
+
+
+class ShardRouter:
+    '''logic_db 的拆分策略编译后的路由表, 表名的路由结果缓存到月底'''
+    def __init__(self, policy):
+        self.default = None
+        # [(类型, 参数, 库名)], 类型: month/re/names
+        self.rules = []
+        self.memo = {}
+        self.expire = 0
+        # 按月的规则在当前月份下最小可以匹配的月份
+        self.windows = {}
+
+        if not policy.get('db'):
             log.info('not found policy:db')
-            return None
-
-        rule = self._info.get('rule')
-        if not rule:
+            return
+        if not policy.get('rule'):
             log.info('not found policy:rule')
-            return None
-
-        default = self._info.get('default')
-        if not default:
+            return
+        if not policy.get('default'):
             log.info('not found policy:default')
-            return None
+            return
 
-        for r,db in rule:
-            #log.debug('%s: %s', r, db)
+        self.default = policy['default']
+        for r, db in policy['rule']:
             if r.startswith('var:'):
-                r1 = r[4:]
-                tx = table.split('_')
-                rx = r1.split('_')
+                rx = r[4:].split('_')
+                last = 0
+                for n in (1, 2, 3):
+                    if r.find('month_last%d' % n) >= 0:
+                        last = n
+                        break
+                if last or r.find('month') >= 0:
+                    self.rules.append(('month', (rx[0], last), db))
+            elif r[0] == '^':
+                self.rules.append(('re', re.compile(r), db))
+            else:
+                self.rules.append(('names', frozenset(r.split(',')), db))
+
+    def _refresh(self, now):
+        '''月份变化时重新计算每个按月规则的窗口, 清空缓存'''
+        month = now.year * 100 + now.month
+        self.windows = {1: (month, month), 2: (month_add(month, -1), None), 3: (month_add(month, -2), None)}
+        self.memo = {}
+        y, m = divmod(now.month, 12)
+        self.expire = datetime.datetime(now.year + y, m + 1, 1).timestamp()
+
+    def route(self, table):
+        if self.default is None:
+            return None
 
-                if tx[0] != rx[0]:
-                    #log.debug('prefix not equal: %s', tx[0])
+        if time.time() >= self.expire:
+            self._refresh(datetime.datetime.now())
+        db = self.memo.get(table)
+        if db is None:
+            db = self._match(table)
+            if len(self.memo) >= ROUTE_MEMO_SIZE:
+                self.memo = {}
+            self.memo[table] = db
+        return db
+
+    def _match(self, table):
+        for kind, arg, db in self.rules:
+            if kind == 'month':
+                tx = table.split('_')
+                prefix, last = arg
+                if tx[0] != prefix:
                     continue
-
-
-                now = datetime.datetime.now()
-                month = '%d%02d' % (now.year, now.month)
-
-                tv1 = int(tx[1])
-                mv1 = int(month)
-                #log.debug('%d %d r1:%s', tv1, mv1, r1)
-                if r1.find('month_last1') >= 0:
-                    if mv1 == tv1:
-                        return db
-                elif r1.find('month_last2') >= 0:
-                    if mv1 - tv1 <= 1:
-                        return db
-                elif r1.find('month_last3') >= 0:
-                    if mv1 - tv1 <= 2:
-                        return db
-                elif r1.find('month') >= 0:
+                if not last:
                     return db
-
-            elif r[0] == '^' and re.match(r, table):
-                return db
-            else:
-                p = r.split(',')
-                if table in p:
+                low, high = self.windows[last]
+                tv = int(tx[1])
+                if tv >= low and (high is None or tv <= high):
+                    return db
+            elif kind == 're':
+                if arg.match(table):
                     return db
+            elif table in arg:
+                return db
+        return self.default
 
 
-        return default
+# 聚合函数在分表结果上的合并方法
+MERGE_FUNCS = {
+    'count': lambda xs: sum(xs),
+    'sum': lambda xs: sum(xs) if xs else None,
+    'min': lambda xs: min(xs) if xs else None,
+    'max': lambda xs: max(xs) if xs else None,
+}
 
-    def _get_conn(self, tname):
-        '''根据表名返回数据库连接对象'''
-        log.debug('get conn: %s', tname)
+class ShardingConnProxy:
+    def __init__(self, manager, name):
+        self._mg = manager
+        self._name = name
+        self._info = manager._dbinfo.get(name)
+        self._router = manager._routers.get(name)
+        self._conn = {}
+        self._last_conn = None
 
+    def _route(self, table):
+        '''根据表名返回对应的数据库名'''
+        if not self._router:
+            return None
+        return self._router.route(table)
+
+    def _db_key(self, tname):
+        '''根据表名返回数据库配置的key'''
         dbnm = self._route(tname)
 
         if not dbnm: # 无数据表映射到库，所以使用默认的库
             dbnm = self._name
 
         # 真实数据库名转换到数据库配置的key名称
-        tb = self._mg._dbname.get(dbnm, dbnm)
+        return self._mg._dbname.get(dbnm, dbnm)
+
+    def _get_conn(self, tname):
+        '''根据表名返回数据库连接对象'''
+        log.debug('get conn: %s', tname)
+
+        tb = self._db_key(tname)
         if tb in self._conn:
             log.debug('get conn %s in cache', tb)
             conn = self._conn[tb]
@@ -140,12 +225,10 @@ class ShardingConnProxy:
     def _get_table(self, sql):
         '''从sql语句中分析出表名，只支持简单查询'''
         # NOTE: 仅能支持只对一个表进行简单的查询
-        p = sql.lower().split()
-        idx = p.index('from')
-        if idx < 0:
+        m = TABLE_RE.search(sql)
+        if not m:
             raise ValueError('not found table')
-        tb = p[idx+1]
-        return tb
+        return m.group(1).lower()
 
 
     def release(self):
@@ -220,6 +303,76 @@ class ShardingConnProxy:
         conn = self._get_conn(table)
         return conn.executemany(sql, param)
 
+    def _scatter(self, tables, func):
+        '''在每个表所在的库上并发执行 func(conn, table), 每个查询单独取连接.
+        返回 (结果列表, 每个表的统计), 有一个表出错就抛出ShardingError'''
+        def run(table):
+            key = self._db_key(table)
+            start = time.time()
+            st = {'table': table, 'db': key, 'rows': 0, 'err': ''}
+            ret = None
+            try:
+                with dbpool.get_connection(key) as conn:
+                    ret = func(conn, table)
+                st['rows'] = len(ret) if isinstance(ret, list) else 1
+            except Exception as e:
+                st['err'] = str(e)
+            st['time'] = int((time.time() - start) * 1000000)
+            return ret, st
+
+        if len(tables) > 1:
+            with ThreadPoolExecutor(min(SCATTER_CONCURRENCY, len(tables))) as executor:
+                results = list(executor.map(run, tables))
+        else:
+            results = [run(t) for t in tables]
+
+        stat = [st for ret, st in results]
+        log.info('func=scatter|tables=%d|time=%s', len(tables),
+                 ','.join(['%s:%d' % (st['table'], st['time']) for st in stat]))
+        errs = [st for st in stat if st['err']]
+        if errs:
+            raise ShardingError('scatter query error %s: %s' % (errs[0]['table'], errs[0]['err']))
+        return [ret for ret, st in results], stat
+
+    def select_shards(self, tables, where=None, fields='*', order=None, limit=None, offset=0):
+        '''在多个分表上查询并合并结果, order/limit 下推到每个表, 合并后再排序和截取.
+        order 如 "ctime desc, id", 返回 (结果, 每个表的统计)'''
+        other = ''
+        if order:
+            other += 'order by ' + order
+        if limit:
+            other += ' limit %d' % (offset + limit)
+
+        rets, stat = self._scatter(tables,
+                lambda conn, table: conn.select(table, where, fields, other or None))
+        rows = []
+        for ret in rets:
+            rows.extend(ret)
+        if order:
+            sort_rows(rows, parse_order(order))
+        if limit:
+            rows = rows[offset: offset + limit]
+        elif offset:
+            rows = rows[offset:]
+        return rows, stat
+
+    def aggregate_shards(self, tables, aggregate, where=None):
+        '''在多个分表上做聚合并合并, aggregate 如 {'n': ('count', '*'), 'total': ('sum', 'amt')},
+        支持 count/sum/min/max. 返回 (结果, 每个表的统计)'''
+        for name, (func, field) in aggregate.items():
+            if func not in MERGE_FUNCS:
+                raise ShardingError('aggregate not support: ' + func)
+        fields = ','.join(['%s(%s) as %s' % (func, field, name)
+                           for name, (func, field) in aggregate.items()])
+
+        rets, stat = self._scatter(tables,
+                lambda conn, table: conn.select_one(table, where, fields))
+        ret = {}
+        for name, (func, field) in aggregate.items():
+            xs = [r[name] for r in rets if r and r[name] is not None]
+            ret[name] = MERGE_FUNCS[func](xs)
+        return ret, stat
+
     def start(self):
         raise ShardingError("not support transaction")
 
@@ -232,27 +385,71 @@ class ShardingConnProxy:
 
 
 class ShardingManager:
-    def __init__(self):
+    def __init__(self, reload_interval=60):
         self._dbinfo = {}
         self._dbname = {}
-        
+        self._routers = {}
+        # 检查dbmeta是否变化的间隔(秒), 0为不检查
+        self.reload_interval = reload_interval
+        self._checked = 0
+        self._version = None
+
         #self.load()
-    
+
+    def set_policy(self, name, policy):
+        self._dbinfo[name] = policy
+        self._routers[name] = ShardRouter(policy)
+
+    def _meta_version(self, conn):
+        '''logic_db内容的摘要, 修改时没有更新utime也能发现'''
+        rows = conn.query('select id, name, policy from logic_db order by id', isdict=False)
+        return hashlib.md5(repr(rows).encode('utf-8')).hexdigest()
+
     def load(self):
         if self._dbname:
             return
+        self.reload()
 
+    def reload(self):
+        '''重新读取dbmeta, 编译好之后一起替换, 正在使用的连接不受影响'''
+        dbinfo = {}
+        routers = {}
         with dbpool.get_connection('dbmeta') as conn:
+            version = self._meta_version(conn)
             ret = conn.select('logic_db')
             if ret:
                 for row in ret:
                     log.debug(row['policy'])
-                    self._dbinfo[row['name']] = json.loads(row['policy'])
+                    dbinfo[row['name']] = json.loads(row['policy'])
+                    routers[row['name']] = ShardRouter(dbinfo[row['name']])
 
         # 真实数据库名和该库的配置KEY的映射
+        dbname = {}
         for name,pool in dbpool.dbpool.items():
-            log.debug('%s => %s', pool.dbcf['db'], name)
-            self._dbname[pool.dbcf['db']] = name
+            db = pool.dbcf.get('db') or pool.dbcf.get('master', {}).get('db')
+            log.debug('%s => %s', db, name)
+            dbname[db] = name
+
+        self._dbinfo, self._routers, self._dbname = dbinfo, routers, dbname
+        self._version = version
+        self._checked = time.time()
+        log.info('func=sharding_load|dbs=%d|version=%s', len(dbinfo), version)
+
+    def check_reload(self):
+        '''间隔reload_interval检查一次dbmeta, logic_db有变化时重新加载'''
+        if not self.reload_interval or time.time() - self._checked < self.reload_interval:
+            return False
+        self._checked = time.time()
+        try:
+            with dbpool.get_connection('dbmeta') as conn:
+                version = self._meta_version(conn)
+            if version == self._version:
+                return False
+            self.reload()
+            return True
+        except:
+            log.error('func=check_reload|error=%s', traceback.format_exc())
+            return False
 
 
 sharding = None
@@ -266,7 +463,9 @@ def install():
 @contextmanager
 def get_connection(name):
     global sharding
+    conn = None
     try:
+        sharding.check_reload()
         conn = ShardingConnProxy(sharding, name)
         yield conn
     except:
@@ -417,6 +616,115 @@ def test():
     time.sleep(10)
 
 
+def test_scatter():
+    '''按月分表在两个库上的并发查询, 排序分页和聚合'''
+    import tempfile, shutil
+    global sharding
+    tmpdir = tempfile.mkdtemp()
+    paths = [os.path.join(tmpdir, '%d.db' % i) for i in range(2)]
+    dbpool.install({
+        'rec': {'engine': 'sqlite', 'db': paths[0], 'conn': 4},
+        'rec-1': {'engine': 'sqlite', 'db': paths[1], 'conn': 4},
+    })
+    sharding = ShardingManager(0)
+    sharding.set_policy('rec', {'db': ['rec', 'rec-1'], 'default': 'rec', 'rule': [['^record_20190[1-3]$', 'rec-1']]})
+
+    tables = month_tables('record', 201811, 201904)
+    assert tables[:3] == ['record_201811', 'record_201812', 'record_201901'] and len(tables) == 6
+    with get_connection('rec') as conn:
+        for i, t in enumerate(tables):
+            c = conn._get_conn(t)
+            c.execute('create table %s(id integer primary key, amt int)' % t)
+            c.insert_many(t, [{'id': i * 10 + j, 'amt': j} for j in range(5)])
+        assert conn._db_key('record_201902') == 'rec-1' and conn._db_key('record_201812') == 'rec'
+
+        rows, stat = conn.select_shards(tables, {'amt': ('>=', 3)}, order='amt desc, id', limit=3, offset=1)
+        assert [(r['amt'], r['id']) for r in rows] == [(4, 14), (4, 24), (4, 34)]
+        assert sort_rows(list(rows), parse_order('`t`.`amt`, t.id desc')) == rows[::-1]
+        assert len(stat) == 6 and all(st['rows'] == 2 for st in stat)
+
+        ret, stat = conn.aggregate_shards(tables, {'n': ('count', '*'), 'total': ('sum', 'amt'),
+                                                   'mx': ('max', 'id')}, {'amt': ('<', 2)})
+        assert ret == {'n': 12, 'total': 6, 'mx': 51}
+
+        try:
+            conn.select_shards(tables + ['record_209901'])
+            assert False
+        except ShardingError as e:
+            print('error:', e)
+    print('scatter ok')
+
+    for name in ('rec', 'rec-1'):
+        dbpool.dbpool.pop(name)
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def test_route(n=100000):
+    '''编译后的路由和原来逐条解析规则的结果一致, 以及路由的耗时'''
+    now = datetime.datetime.now()
+    month = now.year * 100 + now.month
+    policy = {'db': ['db1', 'db2', 'db3'], 'default': 'db1', 'rule': [
+        ['var:record_month_last2', 'db2'], ['^log_\\d+$', 'db3'], ['user,order', 'db2'], ['var:his_month', 'db3']]}
+    router = ShardRouter(policy)
+    cases = {
+        'record_%d' % month: 'db2', 'record_%d' % month_add(month, -1): 'db2',
+        'record_%d' % month_add(month, -2): 'db1', 'log_12': 'db3', 'log_x': 'db1',
+        'user': 'db2', 'order': 'db2', 'users': 'db1', 'his_201901': 'db3',
+    }
+    for t, db in cases.items():
+        assert router.route(t) == db, (t, router.route(t))
+    assert month_add(202001, -1) == 201912 and month_add(201912, 1) == 202001
+
+    start = time.time()
+    for i in range(n):
+        router.route('record_%d' % month)
+    print('route avg: %.2f' % ((time.time() - start) / n * 1000000))
+
+    class M:
+        _dbinfo = {}
+        _routers = {}
+        _dbname = {}
+    proxy = ShardingConnProxy(M, 'x')
+    assert proxy._get_table('SELECT a FROM `Record_201901` where id in (select 1 from b)') == 'record_201901'
+    assert proxy._get_table('insert into t1(a) values (1)') == 't1'
+
+
+def test_reload():
+    '''dbmeta里的策略修改后不重启就生效'''
+    import tempfile, shutil
+    global sharding
+    tmpdir = tempfile.mkdtemp()
+    dbpool.install({'dbmeta': {'engine': 'sqlite', 'db': os.path.join(tmpdir, 'dbmeta.db'), 'conn': 1}})
+    with dbpool.get_connection('dbmeta') as conn:
+        conn.execute('create table logic_db(id integer primary key, name varchar(128), policy varchar(256), utime datetime)')
+        conn.insert('logic_db', {'id': 1, 'name': 'test', 'utime': '2020-01-01 00:00:00',
+                                 'policy': json.dumps({'db': ['a', 'b'], 'default': 'a', 'rule': [['t1', 'b']]})})
+    install()
+    sharding.reload_interval = 0.01
+    assert ShardingConnProxy(sharding, 'test')._route('t1') == 'b'
+    assert not sharding.check_reload()
+
+    with dbpool.get_connection('dbmeta') as conn:
+        conn.update('logic_db', {'utime': '2020-01-02 00:00:00',
+                                 'policy': json.dumps({'db': ['a', 'b'], 'default': 'a', 'rule': [['t2', 'b']]})},
+                    {'id': 1})
+    time.sleep(0.01)
+    assert sharding.check_reload()
+    proxy = ShardingConnProxy(sharding, 'test')
+    assert proxy._route('t1') == 'a' and proxy._route('t2') == 'b'
+
+    # 没有更新utime的修改也能发现
+    with dbpool.get_connection('dbmeta') as conn:
+        conn.update('logic_db', {'policy': json.dumps({'db': ['a', 'b'], 'default': 'a', 'rule': [['t3', 'b']]})},
+                    {'id': 1})
+    time.sleep(0.01)
+    assert sharding.check_reload() and ShardingConnProxy(sharding, 'test')._route('t3') == 'b'
+    print('reload ok')
+
+    dbpool.dbpool.pop('dbmeta')
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+
 def test_main():
     import logger
     logger.install('stdout')
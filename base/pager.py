@@ -2,10 +2,47 @@
 import sys, os
 import copy, traceback
 import math
+import time
+import base64
 import logging
+from zbase3.base import codec
+from zbase3.base.excepts import ParamError
 
 log = logging.getLogger()
 
+# 记录数的缓存 {(库名, sql): (记录数, 过期时间)}
+count_cache = {}
+COUNT_CACHE_SIZE = 1024
+
+def cached_count(key, ttl, func):
+    '''ttl秒内使用缓存的记录数, ttl为0时每次都统计'''
+    now = time.time()
+    if ttl > 0:
+        v = count_cache.get(key)
+        if v and v[1] > now:
+            return v[0]
+    n = func()
+    if ttl > 0:
+        if len(count_cache) >= COUNT_CACHE_SIZE:
+            count_cache.clear()
+        count_cache[key] = (n, now + ttl)
+    return n
+
+def encode_cursor(value):
+    '''游标分页的位置编码为字符串'''
+    return base64.urlsafe_b64encode(codec.dumps([value])).decode('utf-8').rstrip('=')
+
+def decode_cursor(token):
+    '''解码客户端传来的游标, 只接受int, float, str, 格式不对时抛出ParamError'''
+    try:
+        s = token.encode('utf-8')
+        value = codec.loads(base64.urlsafe_b64decode(s + b'=' * (-len(s) % 4)))[0]
+    except Exception:
+        raise ParamError('cursor error')
+    if type(value) not in (int, float, str):
+        raise ParamError('cursor error')
+    return value
+
 class Pager:
     '''分页类'''
     def __init__(self, data, page, pagesize=20):
@@ -115,17 +152,19 @@ class PageDataBase:
         pass
 
 class PageDataDB (PageDataBase):
-    def __init__(self, db, sql, count_sql=None, maxid=-1):
+    def __init__(self, db, sql, count_sql=None, maxid=-1, count_ttl=0):
         '''设置初始值
         db  - 数据库连接对象
         sql - 分页查询sql
         pagesize - 每页显示条数
         maxid - 最大id
+        count_ttl - 记录数缓存的秒数, 0为每次都统计
         '''
         self.db   = db
         self.data = []
         self.url  = ''
         self.maxid = maxid
+        self.count_ttl = count_ttl
 
         sql = sql.replace('%', '%%')
         # 如果设置了最大id，在查询的时候要加上限制，但是这里有问题。可能原来的分页sql已经有where了
@@ -162,9 +201,10 @@ class PageDataDB (PageDataBase):
         '''统计页数'''
         # 没有统计页数的sql，说明不需要计算总共多少页
         #log.info("PageDataDB count sql:%s", self.count_sql)
-        ret = self.db.query(self.count_sql)
-        row = ret[0]
-        self.records = int(row['count'])
+        def count():
+            ret = self.db.query(self.count_sql)
+            return int(ret[0]['count'])
+        self.records = cached_count((getattr(self.db, 'name', ''), self.count_sql), self.count_ttl, count)
         log.debug("PageDataDB count:%s", self.records)
         a = divmod(self.records, pagesize)
         if a[1] > 0:
@@ -174,9 +214,61 @@ class PageDataDB (PageDataBase):
         return self.records, page_count
 
 
-def db_pager(db, sql, pagecur, pagesize, count_sql=None, maxid=-1):
+class PageDataKeyset (PageDataBase):
+    def __init__(self, db, table, key, where=None, fields='*', cursor=None, desc=False, count_ttl=None):
+        '''游标分页, 按唯一且有序的字段key从上一页的最后一条往后查, 不用offset, 翻到多深都一样快
+        cursor - 上一页返回的next, 为空时从第一页开始
+        count_ttl - 记录数缓存的秒数, 0为每次都统计, None为不统计
+        '''
+        self.db = db
+        self.table = table
+        self.key = key
+        self.where = where or {}
+        self.fields = fields
+        self.desc = desc
+        self.last = decode_cursor(cursor) if cursor else None
+        self.count_ttl = count_ttl
+        self.data = []
+        self.next = None
+        self.records = -1
+
+        if fields != '*':
+            names = fields if isinstance(fields, (list, tuple)) else fields.split(',')
+            if key not in [x.strip(' `') for x in names]:
+                self.fields = list(names) + [key]
+
+    def load(self, cur, pagesize, isdict=True):
+        '''加载数据, cur没有用, 位置由cursor决定'''
+        if self.data:
+            return self.data
+        where = dict(self.where)
+        if self.last is not None:
+            # where里已经有key的条件时, 用 表名.key 区分
+            k = self.key if self.key not in where else '%s.%s' % (self.table, self.key)
+            where[k] = ('<' if self.desc else '>', self.last)
+        other = 'order by %s%s limit %d' % (self.key, ' desc' if self.desc else '', pagesize + 1)
+        rows = self.db.select(self.table, where, self.fields, other)
+        if len(rows) > pagesize:
+            rows = rows[:pagesize]
+            self.next = encode_cursor(rows[-1][self.key])
+        self.data = rows if isdict else [tuple(r.values()) for r in rows]
+        return self.data
+
+    def count(self, pagesize):
+        '''统计页数, 不统计时返回 (-1, 0)'''
+        if self.count_ttl is None:
+            return -1, 0
+        def count():
+            ret = self.db.select_one(self.table, self.where or None, 'count(*) as count')
+            return int(ret['count'])
+        key = (getattr(self.db, 'name', ''), self.table, repr(sorted(self.where.items())))
+        self.records = cached_count(key, self.count_ttl, count)
+        return self.records, (self.records + pagesize - 1) // pagesize
+
+
+def db_pager(db, sql, pagecur, pagesize, count_sql=None, maxid=-1, count_ttl=0):
     #log.debug('sql:%s pagecur:%d pagesize:%d', sql, pagecur, pagesize)
-    pgdata = PageDataDB(db, sql, count_sql, maxid)
+    pgdata = PageDataDB(db, sql, count_sql, maxid, count_ttl)
     p = Pager(pgdata, pagecur, pagesize)
     p.split()
     return p
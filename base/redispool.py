@@ -8,8 +8,24 @@ import logging
 
 from contextlib import contextmanager
 
+try:
+    import redis
+except ImportError:
+    redis = None
+
 log = logging.getLogger()
 
+# 共用的redis连接, 每个配置一个 {配置: redis.Redis}
+redis_conns = {}
+
+def get_redis(conf):
+    '''按配置取共用的redis连接, redis.Redis自带连接池, fork之后会自己重建'''
+    key = repr(sorted(conf.items()))
+    conn = redis_conns.get(key)
+    if conn is None:
+        conn = redis_conns[key] = redis.Redis(**conf)
+    return conn
+
 class RedisLockException(Exception):
     pass
 
@@ -70,6 +70,10 @@ class BaseServer (object):
         '''创建主业务处理对象'''
         pass
 
+    def preload(self):
+        '''主进程fork子进程之前执行一次, 可以把公共数据加载到共享内存缓存(web.cache.ShmCache), 子进程共用'''
+        pass
+
 
     def start_worker(self):
         '''运行子进程逻辑'''
@@ -216,6 +220,7 @@ class BaseGeventServer (BaseServer):
         self.server.max_req = max_req
         log.warn('!!! server starting ...')
 
+        self.preload()
         if max_proc == 1:
             self.start_worker()
         else:
@@ -271,6 +276,7 @@ class BaseThreadServer (BaseServer):
 
         self.sock = self.make_server()
 
+        self.preload()
         if max_proc == 1:
             start_worker()
         else:
@@ -14,13 +14,20 @@ import gevent
 from gevent.server import StreamServer, DatagramServer
 from zbase3.server import balance
 from zbase3.server.defines import *
-from zbase3.base import logger
+from zbase3.base import logger, codec
 
 '''
 package format:
-    | package len(8B) | json 
+    version 1:
+    | package len(8B, ascii) | json 
 
-json:
+    version 2:
+    | magic(1B) | body format(1B) | package len(4B, big endian) | msgpack/json
+
+    版本2的第一个字节不是数字，服务端按每个包的第一个字节区分版本，
+    并用请求的版本和格式应答，所以同一个服务可以同时接受两种版本的客户端
+
+json/msgpack:
     request: [version, type, msgid, logid, name, params, extend]
     response: [version, type, msgid, logid, code, result, extend]
 
@@ -31,11 +38,32 @@ log = logging.getLogger()
 
 # 版本
 VERSION = 1
+VERSION2 = 2
+
+# 版本2的包头
+MAGIC = 0xFB
+HEAD_V2 = struct.Struct('>BBI')
+
+# 版本2包体的最大长度, 超过时认为是错误的包, 断开连接. 版本1的长度最多8位数字
+MAX_BODY_SIZE = 64 * 1024 * 1024
+
+# 包体的编码格式
+FMT_JSON = 1
+FMT_MSGPACK = 2
 
 # 调用
 TYPE_CALL  = 100
 # 调用，不需要返回结果。调用方不等待
 TYPE_CALL_NOREPLY = 101
+# 批量调用, params为 [[name, params], ...], 应答的result为 [[retcode, result], ...]
+# 批量调用并发执行
+TYPE_CALL_BATCH = 102
+# 批量调用按顺序执行
+TYPE_CALL_BATCH_SERIAL = 103
+# 批量调用的名字, 以_开头, 不支持批量调用的服务会返回ERR_METHOD
+BATCH_NAME = '_batch'
+# 请求extend里的标记, 多路复用的客户端按msgid匹配应答, 服务端可以并发处理并乱序返回
+EXTEND_MUX = 'mux'
 # 应答
 TYPE_REPLY = 200
 # 应答，处理有异常
@@ -44,6 +72,59 @@ TYPE_REPLY_EXCEPT = 201
 class ProtocolError(Exception):
     pass
 
+
+def encode_body(obj, fmt=FMT_JSON):
+    if fmt == FMT_MSGPACK:
+        return codec.msgpack_dumps(obj)
+    return codec.dumps(obj)
+
+def decode_body(body, fmt=FMT_JSON):
+    if fmt == FMT_MSGPACK:
+        return codec.msgpack_loads(body)
+    return codec.loads(body)
+
+def pack_head(bodylen, version=VERSION, fmt=FMT_JSON):
+    if version >= VERSION2:
+        if bodylen > MAX_BODY_SIZE:
+            raise ProtocolError('package too large: %d' % bodylen)
+        return HEAD_V2.pack(MAGIC, fmt, bodylen)
+    if bodylen > 99999999:
+        raise ProtocolError('package too large for version 1: %d' % bodylen)
+    return b'%08d' % bodylen
+
+def read_frame(read):
+    '''从流中读取一个包, read(n)返回n个字节。返回 (version, fmt, body), 连接关闭返回None'''
+    first = read(1)
+    if not first:
+        return None
+    if first[0] == MAGIC:
+        head = read(HEAD_V2.size - 1)
+        if len(head) != HEAD_V2.size - 1:
+            return None
+        magic, fmt, bodylen = HEAD_V2.unpack(first + head)
+        if bodylen > MAX_BODY_SIZE:
+            raise ProtocolError('package too large: %d' % bodylen)
+        version = VERSION2
+    else:
+        head = read(7)
+        if len(head) != 7:
+            return None
+        bodylen = int(first + head)
+        fmt = FMT_JSON
+        version = VERSION
+    body = read(bodylen)
+    if len(body) != bodylen:
+        raise ProtocolError('read body error, body=%d read=%d' % (bodylen, len(body)))
+    return version, fmt, body
+
+def unpack(data):
+    '''解析一个完整的包(udp), 返回 (version, fmt, body)'''
+    if data[:1] and data[0] == MAGIC:
+        magic, fmt, bodylen = HEAD_V2.unpack(data[:HEAD_V2.size])
+        return VERSION2, fmt, data[HEAD_V2.size:]
+    return VERSION, FMT_JSON, data[8:]
+
+
 class Protocol (object):
     def __init__(self):
         global VERSION
@@ -52,6 +133,18 @@ class Protocol (object):
         self.msgtype = 0
         self.logid = ''
         self.extend = None
+        # 包体编码格式, 版本1只能是json
+        self.fmt = FMT_JSON
+
+    def use_version(self, version, fmt=None):
+        '''设置编码使用的协议版本, 版本2默认使用msgpack'''
+        self.version = version
+        if version >= VERSION2:
+            if fmt is None:
+                fmt = FMT_MSGPACK if codec.msgpack else FMT_JSON
+            self.fmt = fmt
+        else:
+            self.fmt = FMT_JSON
 
     def __str__(self):
         return '<Protocol version:%d msgtype:%d msgid:%d logid:%s>' % \
@@ -88,13 +181,31 @@ class ReqProto (Protocol):
         else:
             self.params = {}
 
+    def call_batch(self, calls, parallel=True):
+        '''批量调用, calls为 [(name, params), ...]'''
+        self.name = BATCH_NAME
+        self.msgtype = TYPE_CALL_BATCH if parallel else TYPE_CALL_BATCH_SERIAL
+        self.params = [[name, params] for name, params in calls]
+
+    def is_batch(self):
+        return self.msgtype in (TYPE_CALL_BATCH, TYPE_CALL_BATCH_SERIAL)
+
+    def set_mux(self):
+        '''标记为多路复用的请求. extend不是dict时不标记, 服务端按顺序处理'''
+        if self.extend is None:
+            self.extend = {}
+        if isinstance(self.extend, dict):
+            self.extend[EXTEND_MUX] = 1
+
+    def is_mux(self):
+        return isinstance(self.extend, dict) and bool(self.extend.get(EXTEND_MUX))
+
     @staticmethod
-    def loads(body):
-        if isinstance(body, bytes):
-            body = body.decode('utf-8')
+    def loads(body, fmt=FMT_JSON):
         #log.debug('load:%s', body)
         p = ReqProto()
-        obj = json.loads(body)
+        p.fmt = fmt
+        obj = decode_body(body, fmt)
         if len(obj) == 6:
             p.version, p.msgtype, p.msgid, p.logid, p.name, p.params = obj
         elif len(obj) == 7:
@@ -109,10 +220,10 @@ class ReqProto (Protocol):
         obj = [self.version, self.msgtype, self.msgid, str(self.logid), self.name, self.params]
         if self.extend:
             obj.append(self.extend)
-        s = json.dumps(obj)
+        s = encode_body(obj, self.fmt)
         if head:
-            s = '%08d' % (len(s)) + s
-        return s.encode('utf-8')
+            s = pack_head(len(s), self.version, self.fmt) + s
+        return s
 
 
 class RespProto (Protocol):
@@ -134,12 +245,10 @@ class RespProto (Protocol):
         self.result = result
 
     @staticmethod
-    def loads(body):
-        if isinstance(body, bytes):
-            body = body.decode('utf-8')
-
+    def loads(body, fmt=FMT_JSON):
         p = RespProto(0)
-        obj = json.loads(body)
+        p.fmt = fmt
+        obj = decode_body(body, fmt)
         if len(obj) == 6:
             p.version, p.msgtype, p.msgid, p.logid, p.retcode, p.result = obj
         elif len(obj) == 7:
@@ -151,18 +260,29 @@ class RespProto (Protocol):
     @staticmethod
     def fromReq(req):
         p = RespProto(req.msgid, req.logid)
+        # 用请求的版本和格式应答
+        p.version = req.version
+        p.fmt = req.fmt
         return p
        
-    def dumps(self, head=True):
+    def dumps(self, head=True, result=None):
+        '''result为已经用json编码好的self.result, 传入时不再重复编码'''
         if self.msgid == 0:
             self.msgid = random.randint(1, 100000000)
-        obj = [self.version, self.msgtype, self.msgid, str(self.logid), self.retcode, self.result]
-        if self.extend:
-            obj.append(self.extend)
-        s = json.dumps(obj)
+        if result is None or self.fmt != FMT_JSON:
+            obj = [self.version, self.msgtype, self.msgid, str(self.logid), self.retcode, self.result]
+            if self.extend:
+                obj.append(self.extend)
+            s = encode_body(obj, self.fmt)
+        else:
+            obj = [self.version, self.msgtype, self.msgid, str(self.logid), self.retcode]
+            s = codec.dumps(obj)[:-1] + b',' + result
+            if self.extend:
+                s += b',' + codec.dumps(self.extend)
+            s += b']'
         if head:
-            s = '%08d' % (len(s)) + s
-        return s.encode('utf-8')
+            s = pack_head(len(s), self.version, self.fmt) + s
+        return s
 
 
 def test_proto():
@@ -184,6 +304,30 @@ def test_proto():
     resp2 = RespProto.loads(p[8:])
     print(resp2.dumps())
 
+    # 版本2
+    req.use_version(VERSION2)
+    req.params = {'data': b'\x00\x01'}
+    p = req.dumps()
+    print(p)
+    version, fmt, body = unpack(p)
+    req2 = ReqProto.loads(body, fmt)
+    assert version == VERSION2 and req2.params == req.params and req2.version == VERSION2
+    resp = RespProto.fromReq(req2)
+    resp.reply(0, b'haha')
+    p = resp.dumps()
+    print(p)
+    version, fmt, body = unpack(p)
+    assert RespProto.loads(body, fmt).result == b'haha'
+
+    # 批量调用
+    req = ReqProto()
+    req.call_batch([('ping', {}), ('add', [1, 2])], parallel=False)
+    req2 = ReqProto.loads(req.dumps()[8:])
+    assert req2.is_batch() and req2.msgtype == TYPE_CALL_BATCH_SERIAL and req2.params[1] == ['add', [1, 2]]
+
+    # 超过99MB的包只有版本2支持
+    assert len(pack_head(200*1024*1024, VERSION2, FMT_MSGPACK)) == HEAD_V2.size
+
 def test():
     f = globals()[sys.argv[1]]
     #print(len(sys.argv))
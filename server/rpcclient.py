@@ -8,14 +8,23 @@ import datetime
 import traceback
 import socket
 import ssl
+import errno
+import threading
 import logging
 import json
+import collections
 import requests
 import gevent
+from gevent.event import AsyncResult
+from gevent.socket import wait_read
+from gevent.lock import Semaphore, BoundedSemaphore
+from gevent import monkey
 from zbase3.server import balance
 from zbase3.server.defines import *
 from zbase3.base import logger
-from zbase3.server.rpc import ReqProto, RespProto
+from zbase3.base import codec
+from zbase3.server.rpc import ReqProto, RespProto, VERSION, VERSION2, read_frame, unpack, ProtocolError
+from zbase3.server.rpc import TYPE_REPLY_EXCEPT
 from zbase3.server.rpcserver import recvall
 from zbase3.server import nameclient
 
@@ -31,12 +40,44 @@ class RPCConnError (Exception):
 class RPCClientERror (Exception):
     pass
 
+RPCClientError = RPCClientERror
+
+class RPCVersionError (Exception):
+    '''服务端不支持当前的协议版本'''
+    pass
+
+
+# tcp客户端默认使用的协议版本. 版本2用msgpack, 结果里dict的int键和bytes不会变成字符串,
+# 和版本1的结果不一样, 所以默认还是版本1, 需要时用Client(version=2)或者改这里
+TCP_VERSION = VERSION
+# 不支持版本2协议的服务器 {addr: 过期时间}, 过期后重新检测
+v1_servers = {}
+# 记录不支持版本2的服务器的时间(秒)
+V1_RECHECK = 300
+# 检测协议版本使用的方法名, 以_开头的方法服务端不会执行, 只返回ERR_METHOD
+PROBE_NAME = '_probe'
+
+def is_v1_server(addr):
+    t = v1_servers.get(addr)
+    if t is None:
+        return False
+    if t < time.time():
+        v1_servers.pop(addr, None)
+        return False
+    return True
+
 class TcpConnection:
-    def __init__(self, addr, timeout=1000, keyfile=None, certfile=None):
+    def __init__(self, addr, timeout=1000, keyfile=None, certfile=None, version=VERSION):
         self.addr = addr
         self.timeout = timeout
         self.keyfile = keyfile
         self.certfile = certfile
+        # 连接使用的协议版本
+        self.version = version
+        if is_v1_server(addr):
+            self.version = VERSION
+        # 当前连接上完成的请求数
+        self.reqs = 0
 
         self.conn = None
         self.connect()
@@ -57,6 +98,7 @@ class TcpConnection:
         t = time.time()
         ret = 0
         msg = ''
+        self.reqs = 0
         try:
             self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.conn.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
@@ -81,21 +123,379 @@ class TcpConnection:
     def peek(self):
         return self.conn.recv(1, socket.MSG_PEEK)
 
-    def recvall(self):
-        head = self.conn.recv(8)
-        if not head:
+    def is_alive(self):
+        '''检查空闲的连接, 对方已关闭或者有没读的数据时返回False'''
+        if not self.conn:
+            return False
+        if self.keyfile: # ssl连接不支持peek
+            return True
+        try:
+            self.conn.settimeout(0)
+            # 空闲连接上不应该有数据, 读到数据或者连接关闭都不能再用
+            self.peek()
+            return False
+        except socket.error as e:
+            return e.errno in (errno.EAGAIN, errno.EWOULDBLOCK)
+        finally:
+            if self.conn:
+                self.conn.settimeout(self.timeout/1000.0 if self.timeout else None)
+
+    def recv_frame(self):
+        frame = read_frame(lambda n: recvall(self.conn, n))
+        if not frame:
             raise RPCConnError('connection closed')
-        bodylen = int(head.decode('utf-8'))
-        #log.debug('recv head:%s %d', repr(head), bodylen)
-        s = recvall(self.conn, bodylen)
-        log.debug('recv:%s', s)
-        return s
+        log.debug('recv:%s', frame[2])
+        self.reqs += 1
+        return frame
+
+    def recvall(self):
+        return self.recv_frame()[2]
 
     def sendall(self, s):
-        log.debug('send:%s', s[8:])
+        log.debug('send:%s', s)
         return self.conn.sendall(s)
 
 
+def probe_version(addr, timeout=500, keyfile=None, certfile=None):
+    '''在新连接上分别用版本2和版本1发一个探测请求, 返回有应答的版本, 都没有应答返回0'''
+    for version in (VERSION2, VERSION):
+        c = None
+        try:
+            c = TcpConnection(addr, timeout, keyfile, certfile, version)
+            c.version = version
+            req = ReqProto()
+            req.call(PROBE_NAME, {})
+            req.use_version(version)
+            c.sendall(req.dumps())
+            c.recv_frame()
+            return version
+        except (socket.error, RPCConnError, ProtocolError, ValueError) as e:
+            log.info('probe %s:%d version %d error: %s', addr[0], addr[1], version, e)
+        finally:
+            if c:
+                c.close()
+    return 0
+
+def check_v1_server(c):
+    '''版本2的新连接上第一个请求没有应答就断开时调用. 探测确认服务端只支持版本1时,
+    记录下来并把连接切换到版本1, 返回True. 普通的连接错误返回False'''
+    if c.version < VERSION2 or c.reqs != 0:
+        return False
+    if probe_version(c.addr, c.timeout, c.keyfile, c.certfile) != VERSION:
+        return False
+    log.warning('server %s:%d not support rpc version 2, use version 1', c.addr[0], c.addr[1])
+    v1_servers[c.addr] = time.time() + V1_RECHECK
+    c.version = VERSION
+    return True
+
+
+class RPCPoolError (Exception):
+    pass
+
+
+# 连接池的默认配置, 服务器配置里的pool可以覆盖
+# min_size: 空闲清理时至少保留的连接数
+# max_size: 最大连接数, 达到后等待其他人归还
+# idle_timeout: 空闲超过这个时间(秒)的连接被关闭
+# wait_timeout: 等待连接的最长时间(秒), None为使用调用超时
+POOL_CONFIG = {'min_size': 1, 'max_size': 32, 'idle_timeout': 60, 'wait_timeout': None}
+
+class ConnectionPool:
+    '''同一个地址的TcpConnection连接池, 等待使用gevent的信号量, 协程之间等待不需要monkey patch.
+    gevent的锁不能可靠地跨原生线程等待, 所以没有monkey patch threading时, get_pool给每个线程一个连接池'''
+    def __init__(self, addr, timeout=1000, keyfile=None, certfile=None, version=VERSION,
+            min_size=1, max_size=32, idle_timeout=60, wait_timeout=None):
+        self.addr = addr
+        self.timeout = timeout
+        self.keyfile = keyfile
+        self.certfile = certfile
+        self.version = version
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout if wait_timeout is not None else timeout/1000.0
+
+        # 空闲连接 (conn, lasttime), 最后归还的在最后
+        self.idle = collections.deque()
+        # 已经打开的连接数, 包括正在使用的
+        self.opened = 0
+
+        # 每个连接占一个名额, 没有名额时等待
+        self.slots = BoundedSemaphore(max_size)
+        self.lock = Semaphore()
+
+        self.clear_stat()
+
+    def clear_stat(self):
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.wait_time = 0
+        self.max_wait_time = 0
+        self.closes = 0
+
+    def _close(self, conn):
+        # 调用时要持有锁
+        conn.close()
+        self.opened -= 1
+        self.closes += 1
+
+    def acquire(self):
+        start = time.time()
+        if not self.slots.acquire(blocking=False):
+            self.waits += 1
+            ok = self.slots.acquire(timeout=self.wait_timeout)
+            self._add_wait(start)
+            if not ok:
+                log.error('func=acquire|addr=%s:%d|error=no idle connections', self.addr[0], self.addr[1])
+                raise RPCPoolError('no idle connections to %s:%d' % self.addr)
+
+        with self.lock:
+            while self.idle:
+                conn, lasttime = self.idle.pop()
+                if start - lasttime > self.idle_timeout or not conn.is_alive():
+                    self._close(conn)
+                    continue
+                self.hits += 1
+                return conn
+            self.opened += 1
+            self.misses += 1
+
+        # 在锁外面建立连接
+        try:
+            return TcpConnection(self.addr, self.timeout, self.keyfile, self.certfile, self.version)
+        except:
+            with self.lock:
+                self.opened -= 1
+            self.slots.release()
+            raise
+
+    def _add_wait(self, start):
+        t = time.time() - start
+        self.wait_time += t
+        self.max_wait_time = max(self.max_wait_time, t)
+
+    def release(self, conn):
+        '''归还连接, 已经关闭的连接不再放回'''
+        now = time.time()
+        with self.lock:
+            if conn.conn:
+                self.idle.append((conn, now))
+            else:
+                self.opened -= 1
+                self.closes += 1
+            self.clear_timeout(now)
+        self.slots.release()
+
+    def clear_timeout(self, now=None):
+        # 调用时要持有锁. 最早归还的在前面, 保留min_size个
+        now = now or time.time()
+        while self.idle and self.opened > self.min_size and now - self.idle[0][1] > self.idle_timeout:
+            conn, lasttime = self.idle.popleft()
+            self._close(conn)
+
+    def close(self):
+        with self.lock:
+            while self.idle:
+                conn, lasttime = self.idle.popleft()
+                self._close(conn)
+
+    def size(self):
+        return len(self.idle), self.opened - len(self.idle)
+
+    def stat(self):
+        reqs = self.hits + self.misses
+        return {'addr': '%s:%d' % self.addr, 'idle': len(self.idle), 'using': self.opened - len(self.idle),
+                'hits': self.hits, 'misses': self.misses, 'waits': self.waits, 'closes': self.closes,
+                'hit_rate': round(self.hits / reqs, 4) if reqs else 0,
+                'avg_wait': int(self.wait_time / self.waits * 1000000) if self.waits else 0,
+                'max_wait': int(self.max_wait_time * 1000000)}
+
+
+# 进程内共享的连接池 {(addr, timeout, keyfile, certfile, version[, 线程id]): ConnectionPool}
+# 不同协议版本的结果类型不一样, 所以版本也要区分
+pools = {}
+pools_lock = threading.Lock()
+
+def get_pool(addr, timeout=1000, keyfile=None, certfile=None, version=VERSION, conf=None):
+    key = (tuple(addr), timeout, keyfile, certfile, version)
+    if not monkey.is_module_patched('threading'):
+        # 原生线程之间不共用连接池
+        key += (threading.get_ident(),)
+    pool = pools.get(key)
+    if pool is None:
+        with pools_lock:
+            pool = pools.get(key)
+            if pool is None:
+                cf = dict(POOL_CONFIG)
+                if conf:
+                    cf.update(conf)
+                pool = ConnectionPool(tuple(addr), timeout, keyfile, certfile, version, **cf)
+                pools[key] = pool
+    return pool
+
+def pool_stat():
+    '''所有连接池的统计, 时间单位为微秒'''
+    return [p.stat() for p in list(pools.values())]
+
+
+class MuxConnection:
+    '''在一个tcp连接上同时发送多个请求, 由读协程按msgid把应答交给等待的请求'''
+    def __init__(self, conn):
+        self.c = conn
+        # 等待应答的请求 {msgid: AsyncResult}
+        self.pending = {}
+        self._wlock = Semaphore()
+        self._reader = None
+
+    def send(self, req):
+        '''发送请求, 返回AsyncResult, 结果为RespProto. 请求标记为多路复用, 服务端可以并发处理'''
+        req.set_mux()
+        s = req.dumps()
+        ev = AsyncResult()
+        with self._wlock:
+            self.c.check_connection()
+            self.pending[req.msgid] = ev
+            try:
+                self.c.sendall(s)
+            except:
+                self.pending.pop(req.msgid, None)
+                raise
+        if self._reader is None:
+            self._reader = gevent.spawn(self._read_loop)
+        return ev
+
+    def cancel(self, msgid):
+        self.pending.pop(msgid, None)
+
+    def _wait_readable(self):
+        '''等到连接上有数据可读, 超时返回False. 这时还没有读任何数据, 连接可以继续使用'''
+        conn = self.c.conn
+        if isinstance(conn, ssl.SSLSocket) and conn.pending():
+            return True
+        try:
+            wait_read(conn.fileno(), self.c.timeout/1000.0 if self.c.timeout else None)
+        except socket.timeout:
+            return False
+        return True
+
+    def _read_loop(self):
+        c = self.c
+        try:
+            # 没有等待的请求时退出, 下次发送再启动
+            while self.pending:
+                # 超时的请求由等待的人自己取消, 不影响连接上的其他请求
+                if not self._wait_readable():
+                    continue
+                version, fmt, body = c.recv_frame()
+                p2 = RespProto.loads(body, fmt)
+                ev = self.pending.pop(p2.msgid, None)
+                if ev is not None:
+                    ev.set(p2)
+                else:
+                    log.info('discard reply, msgid:%d', p2.msgid)
+        except Exception as e:
+            if isinstance(e, (RPCConnError, ConnectionError)) and check_v1_server(c):
+                e = RPCVersionError('server not support version 2')
+            # 连接已经不可用, 所有等待的请求都失败
+            c.close()
+            pending, self.pending = self.pending, {}
+            for ev in pending.values():
+                ev.set_exception(e)
+        finally:
+            self._reader = None
+
+
+class RPCFuture:
+    '''异步调用的结果, get()返回 (retcode, result)'''
+    def __init__(self, mux, req, ev):
+        self._mux = mux
+        self.req = req
+        self._ev = ev
+        self._start = time.time()
+
+    def ready(self):
+        return self._ev.ready()
+
+    def get(self, timeout=None):
+        '''timeout为None时使用连接的超时时间'''
+        req = self.req
+        retcode = -1
+        if timeout is None and self._mux.c.timeout:
+            timeout = self._mux.c.timeout/1000.0
+        try:
+            p2 = self._ev.get(timeout=timeout)
+            retcode = p2.retcode
+            return p2.retcode, p2.result
+        except gevent.Timeout:
+            self._mux.cancel(req.msgid)
+            raise
+        finally:
+            addr = self._mux.c.addr
+            log.info('server=rpc|remote=%s:%d|f=%s|id=%d|arg=%s|t=%d|ret=%d',
+                addr[0], addr[1], req.name, req.msgid, req.params, (time.time()-self._start)*1000000, retcode)
+
+
+class BatchItem:
+    '''批量调用中的一个调用, 批量调用发送后get()返回 (retcode, result)'''
+    def __init__(self, name, params):
+        self.name = name
+        self.params = params
+        self.retcode = None
+        self.result = None
+        self.done = False
+
+    def get(self):
+        if not self.done:
+            raise RPCError('batch not sent')
+        return self.retcode, self.result
+
+
+class Batch:
+    '''收集多个调用一次发送, 用法:
+        with client.batch() as b:
+            x = b.get_user(1)
+            y = b.call('get_user', 2)
+        retcode, result = x.get()
+    '''
+    def __init__(self, client, parallel=True):
+        self._client = client
+        self._parallel = parallel
+        self.items = []
+
+    def call(self, name, *args, **kwargs):
+        if args and kwargs:
+            raise RPCClientError('Call parameter error. Make sure that args and kwargs cannot be both true.')
+        item = BatchItem(name, list(args) if args else kwargs)
+        self.items.append(item)
+        return item
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def _(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+        return _
+
+    def send(self):
+        '''发送收集到的调用, 返回 [(retcode, result), ...]'''
+        items, self.items = self.items, []
+        if not items:
+            return []
+        rets = self._client.call_batch([(x.name, x.params) for x in items], self._parallel)
+        for item, ret in zip(items, rets):
+            item.retcode, item.result = ret[0], ret[1]
+            item.done = True
+        return rets
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.send()
+
+
 class RPCClientBase:
     def __init__(self, server, logid=''):
         self._c = None
@@ -191,6 +591,14 @@ class RPCClientBase:
     def _send_recv(self, s):
         return 'addr', 'data'
 
+    def _dumps(self, req):
+        return req.dumps()
+
+    def _request(self, req):
+        '''发送请求并等待应答, 返回 (addr, RespProto)'''
+        addr, data = self._send_recv(self._dumps(req))
+        return addr, RespProto.loads(data, req.fmt)
+
     def _call(self, req):
         log.debug('call %s %s', req.name, req.params)
         t1 = time.time()
@@ -202,21 +610,25 @@ class RPCClientBase:
                 req.logid = self._logid
             req.msgid = self._seqid
             self._seqid += 1
-            s = req.dumps()
             #log.debug('req:%s', req)
             for i in (1,2):
                 try:
-                    addr, data = self._send_recv(s)
+                    addr, p2 = self._request(req)
                     break
+                except RPCVersionError as e:
+                    # 已经切换到了服务端支持的版本，重试
+                    if i == 1:
+                        continue
+                    raise
                 except socket.error as e:
                     if i == 1:
                         log.info('socket error: ' + traceback.format_exc() + '\n, retry...')
-                        self._c.close()
+                        if self._c:
+                            self._c.close()
                         continue 
                     else:
                         raise
 
-            p2 = RespProto.loads(data)
             if p2.msgid != req.msgid:
                 raise RPCError('seqid error: %d,%d' % (req.msgid, p2.msgid))
             retcode = p2.retcode
@@ -231,7 +643,7 @@ class RPCClientBase:
                 addr[0], addr[1], req.name, req.msgid, req.params, (t2-t1)*1000000, retcode)
 
 
-    def _call_args(self, name, args, kwargs):
+    def _make_req(self, name, args, kwargs):
         p = ReqProto(self._logid)
         p.name = name
         if args and kwargs:
@@ -240,10 +652,30 @@ class RPCClientBase:
             p.params = args
         else:
             p.params = kwargs
+        return p
 
-        p2 = self._call(p)
+    def _call_args(self, name, args, kwargs):
+        p2 = self._call(self._make_req(name, args, kwargs))
         return p2.retcode, p2.result
 
+    def call_batch(self, calls, parallel=True):
+        '''一次发送多个调用, calls为 [(name, params), ...], 返回 [(retcode, result), ...]
+        parallel为True时服务端并发执行, 否则按顺序执行'''
+        p = ReqProto(self._logid)
+        p.call_batch(calls, parallel)
+        p2 = self._call(p)
+        if p2.msgtype == TYPE_REPLY_EXCEPT and p2.retcode == ERR_METHOD:
+            # 服务端不支持批量调用, 逐个调用
+            log.info('server not support batch call, call one by one')
+            return [self._call_args(name, params if isinstance(params, (list, tuple)) else (), 
+                        params if isinstance(params, dict) else {}) for name, params in calls]
+        if p2.retcode != OK:
+            raise RPCError('batch call error: %s %s' % (p2.retcode, p2.result))
+        return [tuple(x[:2]) for x in p2.result]
+
+    def batch(self, parallel=True):
+        return Batch(self, parallel)
+
     def __getattr__(self, name):
         def _(*args, **kwargs):
             return self._call_args(name, args, kwargs)
@@ -252,12 +684,19 @@ class RPCClientBase:
 
 
 class TCPClient (RPCClientBase):
-    def __init__(self, server, logid='', keyfile=None, certfile=None):
+    def __init__(self, server, logid='', keyfile=None, certfile=None, version=None, multiplex=False, pool=True):
         RPCClientBase.__init__(self, server, logid)
 
         self._keyfile = keyfile
         self._certfile = certfile
         self._last_time = 0
+        self._version = version or TCP_VERSION
+        # 多路复用: 多个协程共用这个客户端时, 请求同时发出, 按msgid匹配应答
+        self._multiplex = multiplex
+        self._mux = None
+        # 使用进程内共享的连接池, 每次调用时取出连接, 调用完归还
+        self._use_pool = pool and not multiplex
+        self._pool = None
 
         self._connect()
 
@@ -267,7 +706,13 @@ class TCPClient (RPCClientBase):
            
             self._set_timeout(serv)
             try:
-                self._c = TcpConnection(serv['addr'], self._timeout, self._keyfile, self._certfile)
+                if self._use_pool:
+                    self._pool = get_pool(serv['addr'], self._timeout, self._keyfile, self._certfile,
+                                          self._version, serv.get('pool'))
+                    # 先取一个连接, 连不上时换一个服务器
+                    self._pool.release(self._pool.acquire())
+                else:
+                    self._c = TcpConnection(serv['addr'], self._timeout, self._keyfile, self._certfile, self._version)
             except socket.error:
                 log.error('connect error: ' + traceback.format_exc())
                 self._serverlist.fail(serv)
@@ -278,10 +723,72 @@ class TCPClient (RPCClientBase):
                 log.error(traceback.format_exc())
             break
 
+    def _dumps(self, req):
+        req.use_version(self._c.version)
+        return req.dumps()
+
+    def _get_mux(self):
+        if self._c is None:
+            # 连接池模式下使用异步调用, 单独建立一个连接
+            self._c = TcpConnection(self._server['addr'], self._timeout, self._keyfile, self._certfile, self._version)
+        if self._mux is None or self._mux.c is not self._c:
+            self._mux = MuxConnection(self._c)
+        return self._mux
+
+    def _request(self, req):
+        if self._multiplex:
+            mux = self._get_mux()
+            req.use_version(mux.c.version)
+            ev = mux.send(req)
+            try:
+                return mux.c.addr, ev.get(timeout=self._timeout/1000.0)
+            except gevent.Timeout:
+                # 只取消这个请求, 连接上还有其他请求, 不能关闭
+                mux.cancel(req.msgid)
+                raise RPCError('call %s timeout' % req.name)
+
+        if self._pool is None:
+            return RPCClientBase._request(self, req)
+
+        c = self._pool.acquire()
+        try:
+            req.use_version(c.version)
+            addr, data = self._conn_send_recv(c, req.dumps())
+            return addr, RespProto.loads(data, req.fmt)
+        except:
+            # 出错的连接状态未知, 不再放回连接池
+            c.close()
+            raise
+        finally:
+            self._pool.release(c)
+
+    def call_async(self, name, *args, **kwargs):
+        '''发出调用不等待应答, 返回RPCFuture, future.get()得到 (retcode, result)
+        使用后这个客户端切换为多路复用模式'''
+        self._multiplex = True
+        req = self._make_req(name, args, kwargs)
+        if not req.logid:
+            req.logid = self._logid
+        req.msgid = self._seqid
+        self._seqid += 1
+        mux = self._get_mux()
+        req.use_version(mux.c.version)
+        return RPCFuture(mux, req, mux.send(req))
+
     def _send_recv(self, s):
-        self._c.check_connection()
-        self._c.sendall(s) 
-        return self._c.addr, self._c.recvall()
+        return self._conn_send_recv(self._c, s)
+
+    def _conn_send_recv(self, c, s):
+        c.check_connection()
+        try:
+            c.sendall(s)
+            return c.addr, c.recvall()
+        except (RPCConnError, ConnectionError):
+            # 新连接上的第一个版本2请求就被断开, 探测确认服务端只支持版本1后换成版本1
+            if check_v1_server(c):
+                c.close()
+                raise RPCVersionError('server not support version 2')
+            raise
 
     def _restore_send_recv(self, addr, s):
         c = None
@@ -308,7 +815,7 @@ class UDPClient (RPCClientBase):
         log.debug('send:%s', s)
         self._c.sendto(s, addr)
         data, newaddr = self._c.recvfrom(1000)
-        return newaddr, data[8:]
+        return newaddr, unpack(data)[2]
 
     def _restore_send_recv(self, addr, s):
         c = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -344,13 +851,13 @@ class HTTPClient (RPCClientBase):
         raise ValueError('request error! code:%d' % resp.status_code)
 
 
-def Client(addr, logid='', proto='tcp'):
+def Client(addr, logid='', proto='tcp', version=None, multiplex=False, pool=True):
     if proto == 'udp':
         return UDPClient(addr, logid)
     elif proto == 'http':
         return HTTPClient(addr, logid)
     else:
-        return TCPClient(addr, logid)
+        return TCPClient(addr, logid, version=version, multiplex=multiplex, pool=pool)
 
 def test_client(port=7000):
     import pprint
@@ -419,6 +926,22 @@ def test_client_perf(port=7000):
 
     print('n:', n, 'avg:', int(((end-start)/n)*1000000))
 
+def test_client_perf_pool(port=7000, n=1000):
+    '''每次调用都新建客户端, 对比使用连接池和不使用的耗时'''
+    global log
+    log = logger.install('stdout')
+    log.setLevel(logging.WARNING)
+
+    addr = {'addr':('127.0.0.1', port), 'timeout':1000}
+    for pool in (False, True):
+        start = time.time()
+        for i in range(0, n):
+            p = Client(addr, pool=pool)
+            p.ping()
+        end = time.time()
+        print('pool:', pool, 'n:', n, 'avg:', int(((end-start)/n)*1000000))
+    print(pool_stat())
+
 def test_client_perf_long(port=7000):
     global log
     log = logger.install('stdout')
@@ -434,6 +957,168 @@ def test_client_perf_long(port=7000):
     print('n:', n, 'avg:', int(((end-start)/n)*1000000))
 
 
+def test_client_async(port=7000, n=1000):
+    '''一个连接上同时发出n个请求'''
+    global log
+    log = logger.install('stdout')
+    log.setLevel(logging.WARNING)
+
+    addr = {'addr':('127.0.0.1', port), 'timeout':5000}
+    p = Client(addr)
+    start = time.time()
+    futures = [p.call_async('ping') for i in range(0, n)]
+    for f in futures:
+        assert f.get()[0] == 0
+    end = time.time()
+    print('async n:', n, 'avg:', int(((end-start)/n)*1000000))
+
+    # 多个协程共用一个客户端
+    p = Client(addr, multiplex=True)
+    start = time.time()
+    gs = [gevent.spawn(p.ping) for i in range(0, n)]
+    gevent.joinall(gs, raise_error=True)
+    end = time.time()
+    print('multiplex n:', n, 'avg:', int(((end-start)/n)*1000000))
+
+
+def test_version():
+    '''连接错误不降级, 只支持版本1的服务端探测后降级, 记录过期后重新检测'''
+    from zbase3.server import rpcserver
+    from zbase3.server.rpc import MAGIC
+
+    class V1Server (rpcserver.TCPServer):
+        def handle(self, sock, addr):
+            # 老的服务端收到版本2的包头解析失败, 直接断开
+            if sock.recv(1, socket.MSG_PEEK)[:1] == bytes([MAGIC]):
+                sock.close()
+                return
+            rpcserver.TCPServer.handle(self, sock, addr)
+
+    v2 = rpcserver.TCPServer(('127.0.0.1', 0), rpcserver.Handler)
+    v1 = V1Server(('127.0.0.1', 0), rpcserver.Handler)
+    v2.start()
+    v1.start()
+    v2addr, v1addr = v2.address, v1.address
+    try:
+        assert probe_version(v2addr) == VERSION2 and probe_version(v1addr) == VERSION
+
+        # 版本2的服务端上连接被断开, 不降级
+        c = TcpConnection(v2addr, 1000, version=VERSION2)
+        assert not check_v1_server(c) and c.version == VERSION2 and not is_v1_server(v2addr)
+        c.close()
+
+        p = TCPClient({'addr': v1addr, 'timeout': 1000}, version=VERSION2, pool=False)
+        assert p.ping()[0] == 0 and is_v1_server(v1addr)
+        assert TcpConnection(v1addr, 1000, version=VERSION2).version == VERSION
+
+        # 过期后重新使用版本2
+        v1_servers[v1addr] = time.time() - 1
+        assert not is_v1_server(v1addr) and v1addr not in v1_servers
+        assert TcpConnection(v2addr, 1000, version=VERSION2).version == VERSION2
+        assert TCPClient({'addr': v2addr, 'timeout': 1000}, version=VERSION2).ping()[0] == 0
+        assert not is_v1_server(v2addr)
+        # 默认使用版本1
+        assert TCPClient({'addr': v2addr, 'timeout': 1000}, pool=False)._c.version == VERSION
+
+        # 包体长度超过限制时服务端断开连接
+        from zbase3.server.rpc import HEAD_V2, FMT_MSGPACK, MAX_BODY_SIZE
+        s = socket.create_connection(v2addr, 1)
+        s.sendall(HEAD_V2.pack(MAGIC, FMT_MSGPACK, MAX_BODY_SIZE + 1))
+        assert s.recv(1) == b''
+        s.close()
+    finally:
+        v1.stop()
+        v2.stop()
+    # 服务端停止后探测不到版本
+    assert probe_version(v2addr) == 0
+    print('version ok')
+
+
+def test_mux():
+    '''默认按顺序处理, 多路复用的请求并发处理, 超时只影响超时的请求'''
+    from zbase3.server import rpcserver
+
+    class H (rpcserver.Handler):
+        def slow(self, t, v):
+            gevent.sleep(t)
+            return v
+
+    srv = rpcserver.TCPServer(('127.0.0.1', 0), H)
+    srv.start()
+    try:
+        # 一个连接上连续发出的普通请求, 应答和请求的顺序一样
+        c = TcpConnection(srv.address, 1000)
+        reqs = []
+        for i in range(3):
+            req = ReqProto()
+            req.call('slow', [0.03 - i * 0.01, i])
+            reqs.append(req)
+        c.sendall(b''.join(r.dumps() for r in reqs))
+        assert [RespProto.loads(c.recvall()).result for r in reqs] == [0, 1, 2]
+        c.close()
+
+        p = Client({'addr': srv.address, 'timeout': 100}, multiplex=True)
+        start = time.time()
+        fs = [p.call_async('slow', 0.05, i) for i in range(10)]
+        assert [f.get() for f in fs] == [(0, i) for i in range(10)]
+        assert time.time() - start < 0.1
+
+        # 连接超时时间内没有应答, 不影响超时时间更长的请求
+        f1 = p.call_async('slow', 0.15, 1)
+        f2 = p.call_async('slow', 0.3, 2)
+        assert f1.get(timeout=1) == (0, 1)
+        try:
+            f2.get()
+            assert False
+        except gevent.Timeout:
+            pass
+        assert p.slow(0, 3) == (0, 3)
+    finally:
+        srv.stop()
+    print('mux ok')
+
+
+def test_pool_wait():
+    '''没有monkey patch时, 协程等待连接不会阻塞其他协程'''
+    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    srv.bind(('127.0.0.1', 0))
+    srv.listen(16)
+    pool = ConnectionPool(srv.getsockname(), 1000, max_size=1, wait_timeout=1)
+
+    def use(t):
+        c = pool.acquire()
+        gevent.sleep(t)
+        pool.release(c)
+
+    gs = [gevent.spawn(use, 0.05) for i in range(4)]
+    gevent.joinall(gs, raise_error=True)
+    st = pool.stat()
+    assert st['misses'] == 1 and st['hits'] == 3 and st['waits'] == 3 and st['using'] == 0, st
+
+    # 没有monkey patch时每个线程一个连接池, patch之后共用
+    ret = []
+    th = threading.Thread(target=lambda: ret.append(get_pool(srv.getsockname())))
+    th.start()
+    th.join()
+    patched = monkey.is_module_patched('threading')
+    assert (ret[0] is get_pool(srv.getsockname())) == patched
+    # 不同协议版本的客户端不共用连接池
+    assert get_pool(srv.getsockname(), version=VERSION2).version == VERSION2
+    assert get_pool(srv.getsockname(), version=VERSION).version == VERSION
+
+    pool.wait_timeout = 0.05
+    c = pool.acquire()
+    try:
+        pool.acquire()
+        assert False
+    except RPCPoolError:
+        pass
+    pool.release(c)
+    pool.close()
+    srv.close()
+    print('pool wait ok', pool.stat())
+
+
 def test():
     f = globals()[sys.argv[1]]
     #print(len(sys.argv))
@@ -5,9 +5,13 @@ if __name__ == '__main__':
 
     monkey.patch_all()
 
+import inspect
 from gevent.pywsgi import WSGIServer
+from gevent.pool import Pool
+from gevent.lock import Semaphore
 from zbase3.base.excepts import MethodError, MethodFail
 from zbase3.server.rpc import *
+from zbase3.base import codec
 from zbase3.web import core
 from zbase3.web.validator import with_anno_check
 
@@ -27,28 +31,51 @@ def recvall(sock, count):
     return b''.join(buf)
 
 
-def call_handler(handlercls, data, addr, allow_noreply=True, vlog=True, dumpheader=True):
-    p1 = ReqProto.loads(data)
-    p2 = RespProto.fromReq(p1)
-
-    start = time.time()
+# 处理类的方法 {(handlercls, name): 加了参数校验的函数}
+method_cache = {}
+# 参数校验后的函数 {原函数: 加了参数校验的函数}
+anno_cache = {}
+
+def anno_check(func):
+    fn = anno_cache.get(func)
+    if fn is None:
+        fn = anno_cache[func] = with_anno_check(func)
+    return fn
+
+def resolve_method(handlercls, name):
+    '''查找处理类上定义的方法, 找到返回加了参数校验的函数并缓存, 否则返回None'''
+    key = (handlercls, name)
+    fn = method_cache.get(key)
+    if fn is None and '.' not in name and not name.startswith('_'):
+        f = getattr(handlercls, name, None)
+        if inspect.isfunction(f):
+            fn = method_cache[key] = anno_check(f)
+    return fn
+
+def invoke(handlercls, p1, p2, addr):
+    '''调用p1对应的方法, 结果放在p2里'''
     try:
         log.debug('call %s %s', p1.name, p1.params)
         handler = handlercls(addr, p1, p2)
         if hasattr(handler, "_initial"):
             handler._initial()
 
-        f = obj = handler
-        for name in p1.name.split('.', 1):
-            if name.startswith('_'):
-                raise MethodError()
-            obj = f
-            f = getattr(f, name, None)
-            if not f:
-                raise MethodError()
-
-        # XXX 装饰器兼容, 防止self参数丢掉
-        fn = with_anno_check(f.__func__)
+        fn = resolve_method(handlercls, p1.name)
+        if fn is not None:
+            obj = handler
+        else:
+            # 多级的名字或者实例上的属性, 每次查找
+            f = obj = handler
+            for name in p1.name.split('.', 1):
+                if name.startswith('_'):
+                    raise MethodError()
+                obj = f
+                f = getattr(f, name, None)
+                if not f:
+                    raise MethodError()
+
+            # XXX 装饰器兼容, 防止self参数丢掉
+            fn = anno_check(f.__func__)
         if isinstance(p1.params, dict):
             p2ret = fn(obj, **p1.params)
         else:
@@ -83,17 +110,82 @@ def call_handler(handlercls, data, addr, allow_noreply=True, vlog=True, dumphead
         p2.retcode = ERR_EXCEPT
         p2.result = str(e)
         log.info(traceback.format_exc())
+
+
+# 一个批量调用最多包含的调用数
+BATCH_MAX = 1000
+# 批量调用并发执行时同时运行的协程数
+BATCH_CONCURRENCY = 32
+
+def invoke_batch(handlercls, p1, p2, addr):
+    '''批量调用, 每个调用的结果为 [retcode, result] 或 [retcode, result, extend]'''
+    calls = p1.params
+    if not isinstance(calls, list) or len(calls) > BATCH_MAX:
+        p2.retcode = ERR_PARAM
+        p2.result = 'batch must be a list of at most %d calls' % BATCH_MAX
+        return
+
+    def run(item):
+        sub = ReqProto(p1.logid, p1.extend)
+        sub.version, sub.fmt, sub.msgid = p1.version, p1.fmt, p1.msgid
+        sub2 = RespProto.fromReq(sub)
+        try:
+            sub.name, sub.params = item
+        except (TypeError, ValueError):
+            return [ERR_PARAM, 'batch item must be [name, params]']
+        invoke(handlercls, sub, sub2, addr)
+        if sub2.extend:
+            return [sub2.retcode, sub2.result, sub2.extend]
+        return [sub2.retcode, sub2.result]
+
+    if p1.msgtype == TYPE_CALL_BATCH and len(calls) > 1:
+        pool = Pool(BATCH_CONCURRENCY)
+        p2.result = pool.map(run, calls)
+    else:
+        p2.result = [run(item) for item in calls]
+    p2.retcode = OK
+
+
+def call_handler(handlercls, data, addr, allow_noreply=True, vlog=True, dumpheader=True, fmt=FMT_JSON):
+    p1 = data if isinstance(data, ReqProto) else ReqProto.loads(data, fmt)
+    p2 = RespProto.fromReq(p1)
+
+    start = time.time()
+    try:
+        if p1.is_batch():
+            invoke_batch(handlercls, p1, p2, addr)
+        else:
+            invoke(handlercls, p1, p2, addr)
     finally:
+        # json的结果只编码一次，日志和应答共用
+        result = None
+        if p2.fmt == FMT_JSON:
+            try:
+                result = codec.dumps(p2.result)
+            except Exception as e:
+                log.info(traceback.format_exc())
+                p2.msgtype = TYPE_REPLY_EXCEPT
+                p2.retcode = ERR_EXCEPT
+                p2.result = str(e)
+                result = codec.dumps(p2.result)
         if vlog:
             end = time.time()
             log.info('f=%s|remote=%s:%d|id=%d|t=%d|arg=%s|mt=%d|ret=%d|data=%s',
                      p1.name, addr[0], int(addr[1]), p1.msgid, int((end - start) * 1000000),
-                     p1.params, p2.msgtype, p2.retcode, json.dumps(p2.result))
+                     p1.params, p2.msgtype, p2.retcode,
+                     result.decode('utf-8') if result is not None else p2.result)
 
     if allow_noreply and p1.msgtype == TYPE_CALL_NOREPLY:
         return ''
 
-    ret = p2.dumps(dumpheader)
+    try:
+        ret = p2.dumps(dumpheader, result)
+    except Exception as e:
+        log.info(traceback.format_exc())
+        p2.msgtype = TYPE_REPLY_EXCEPT
+        p2.retcode = ERR_EXCEPT
+        p2.result = str(e)
+        ret = p2.dumps(dumpheader)
     return ret
 
 
@@ -118,36 +210,59 @@ class ServerHandler:
 
 
 class TCPServerHandler(ServerHandler):
+    # 每个连接上同时处理的最大请求数, 超过时暂停读取. 默认为1, 按顺序逐个处理, 应答和请求的顺序一样
+    max_inflight = 1
+    # 多路复用的客户端标记过的请求(extend里有mux)并发处理, 这是同时处理的最大数
+    mux_inflight = 128
+
     def handle(self, sock, addr):
-        def read_data(n):
-            ret = recvall(sock, n)
-            if isinstance(ret, bytes):
-                return ret.decode('utf-8')
-            return ret
+        # 多个请求并发处理，应答按完成的顺序写回，写的时候要加锁
+        wlock = Semaphore()
 
         def write_data(data):
             if isinstance(data, str):
                 data = data.encode('utf-8')
-            return sock.sendall(data)
+            with wlock:
+                return sock.sendall(data)
 
+        def process(p1):
+            ret = call_handler(self._handlercls, p1, addr, True, True)
+            if ret:
+                try:
+                    write_data(ret)
+                except socket.error as e:
+                    log.info('write reply error, %s', e)
+
+        pool = None
         while True:
             self.check_req()
 
-            headstr = read_data(8)
-            # log.debug('read head:%s', headstr)
-            if not headstr:
+            try:
+                frame = read_frame(lambda n: recvall(sock, n))
+            except (ProtocolError, ValueError) as e:
+                log.info('read rpc body error, %s', e)
+                break
+            if not frame:
                 log.debug('client conn close, break')
                 break
-            bodylen = int(headstr)
-            data = read_data(bodylen)
+            version, fmt, data = frame
             # log.debug('read body:%s', data)
-            if not data or len(data) != bodylen:
-                log.info('read rpc body error, body=%d read=%d', bodylen, len(data))
-                break
+            p1 = ReqProto.loads(data, fmt)
 
-            ret = call_handler(self._handlercls, data, addr, True, True)
-            if ret:
-                write_data(ret)
+            if self.max_inflight > 1 or p1.is_mux():
+                # 请求里都带有msgid, 客户端按msgid匹配应答, 所以可以乱序返回
+                if pool is None:
+                    pool = Pool(self.max_inflight if self.max_inflight > 1 else self.mux_inflight)
+                pool.spawn(process, p1)
+            else:
+                # 没有标记的请求等前面并发的请求处理完, 再按顺序处理
+                if pool is not None:
+                    pool.join()
+                process(p1)
+
+        # 等已经收到的请求处理完再关闭连接
+        if pool is not None:
+            pool.join()
 
 
 class TCPServer(StreamServer, TCPServerHandler):
@@ -160,7 +275,8 @@ class UDPServerHandler(ServerHandler):
     def handle(self, data, addr):
         self.check_req()
 
-        ret = call_handler(self._handlercls, data[8:], addr, True, True)
+        version, fmt, body = unpack(data)
+        ret = call_handler(self._handlercls, body, addr, True, True, fmt=fmt)
         if ret:
             self.socket.sendto(ret, addr)
 
@@ -265,6 +381,31 @@ def test_http_server(port=7000):
     server.start()
 
 
+def test_call_perf(n=100000):
+    '''call_handler处理一个简单ping的耗时, 单位微秒'''
+    global log
+    log = logger.install('stdout')
+    log.setLevel(logging.WARNING)
+
+    class MyHandler(Handler):
+        def ping(self):
+            return 0, 'pong'
+
+    addr = ('127.0.0.1', 0)
+    for version in (VERSION, VERSION2):
+        req = ReqProto()
+        req.call('ping', {})
+        req.use_version(version)
+        version, fmt, body = unpack(req.dumps())
+        call_handler(MyHandler, body, addr, fmt=fmt)
+
+        start = time.time()
+        for i in range(0, n):
+            call_handler(MyHandler, body, addr, vlog=False, fmt=fmt)
+        end = time.time()
+        print('version:', version, 'n:', n, 'avg:', round((end - start) / n * 1000000, 2))
+
+
 def test():
     f = globals()[sys.argv[1]]
     if len(sys.argv) == 3:
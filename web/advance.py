@@ -3,7 +3,7 @@
 from zbase3.web.core import Handler, HandlerFinish
 from zbase3.web import session
 from zbase3.web.httpcore import Response, NotFound
-import json
+from zbase3.base import codec
 import logging
 
 log = logging.getLogger()
@@ -110,10 +110,11 @@ class APIHandler (Handler):
             obj['data'] = data
         else:
             obj['data'] = {}
-        s = json.dumps(obj)
+        s = codec.dumps(obj)
         #log.info('succ: %s', s)
         self.write(s)
-        return s
+        # 写出去的是bytes, 返回值保持str
+        return s.decode('utf-8')
 
     def fail(self, ret=ERR, err='internal error', debug='', data=None):
         '''成功返回的结构，如果结果不一样，需要重新定义'''
@@ -124,10 +125,11 @@ class APIHandler (Handler):
             obj['data'] = data
         else:
             obj['data'] = {}
-        s = json.dumps(obj)
+        s = codec.dumps(obj)
         #log.info('fail: %s', s)
         self.write(s)
-        return s
+        # 写出去的是bytes, 返回值保持str
+        return s.decode('utf-8')
 
 
 
@@ -4,103 +4,485 @@ import time
 import traceback
 import types
 import logging
+import inspect
+import threading
+import mmap
+import struct
+import hashlib
+from collections import OrderedDict
+from zbase3.base import codec, redispool
 
 log = logging.getLogger()
 
 # 两种缓存模式
 # 1. 所有缓存key共用同一个更新函数
 # 2. 缓存为每个key都设置一个更新函数
+# 最多保存maxsize个key, 超过时淘汰最久没用的(模式2用add加的key也会淘汰), maxsize为None时不限制.
+# 过期后只有一个调用者去更新, 更新期间其他调用者拿到旧数据
 class Cache (object):
-    def __init__(self, func=None, timeout=10):
-        self._cache = {}
+    def __init__(self, func=None, timeout=10, maxsize=10000):
+        self._cache = OrderedDict()
         # 以下为缓存模式1所用，只有模式1才需要
         self._func = func
         self._timeout = timeout
-
-    def add(self, key, update_func, timeout):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self.clear_stat()
+
+    def clear_stat(self):
+        self.stat_hit = 0
+        self.stat_miss = 0
+        self.stat_stale = 0
+        self.stat_evict = 0
+        self.stat_error = 0
+
+    def stat(self):
+        '''命中, 没有命中, 更新期间返回旧数据, 淘汰和更新出错的次数'''
+        return {'size': len(self._cache), 'max': self.maxsize, 'hit': self.stat_hit, 'miss': self.stat_miss,
+                'stale': self.stat_stale, 'evict': self.stat_evict, 'error': self.stat_error}
+
+    def _new_item(self, key, func, timeout):
+        # 调用时要持有锁
+        item = {'key':key, 'func':func, 'timeout':timeout, 'last':0, 'data':None,
+                'loaded':False, 'loading':None}
+        self._cache[key] = item
+        while self.maxsize and len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+            self.stat_evict += 1
+        return item
+
+    def add(self, key, update_func, timeout, replace=True):
         if key:
             # 以下为模式2
-            item = {'key':key, 'func':update_func, 'timeout':timeout, 'last':0, 'data':None}
-            self._cache[key] = item
+            with self._lock:
+                if replace or key not in self._cache:
+                    self._new_item(key, update_func, timeout)
         else:
             # 以下为模式1
-            self._func = func
+            self._func = update_func
             self._timeout = timeout
 
     def exist(self, key):
         return key in self._cache
 
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
     def remove(self, key):
-        if key in self._cache:
-            self._cache.pop(key)
+        with self._lock:
+            self._cache.pop(key, None)
 
     def update(self, key, *args, **kwargs):
         item = self._cache.get(key)
         if not item:
             return
+        return self._load(key, item, *args, **kwargs)
 
+    def _load(self, key, item, *args, **kwargs):
         now = time.time()
         data = item['func'](key, item['data'], item, *args, **kwargs)
         item['data'] = data
         item['last'] = now
+        item['loaded'] = True
 
         return data
- 
-    def __call__(self, key, _refresh=False, *args, **kwargs):
-        item = self._cache.get(key)
-        if not item:
-            if not self._func:
-                return
-            item = {'func':self._func, 'timeout':self._timeout, 'last':0, 'data':None}
-            self._cache[key] = item
 
-        data = item['data']
-        now = time.time()
-        if _refresh or now-item['last'] >= item['timeout']:
-            data = self.update(key, *args, **kwargs)
-        return data
+    def _refresh(self, key, item, *args, **kwargs):
+        '''更新数据, 出错时有旧数据就返回旧数据'''
+        try:
+            return self._load(key, item, *args, **kwargs)
+        except Exception:
+            self.stat_error += 1
+            if not item['loaded']:
+                raise
+            log.warning('cache refresh error, use stale data: %s %s', key, traceback.format_exc())
+            return item['data']
+        finally:
+            with self._lock:
+                event, item['loading'] = item['loading'], None
+            event.set()
 
-# 这是第2种缓存
-caches = Cache()
+    def __call__(self, key, _refresh=False, *args, **kwargs):
+        now = time.time()
+        with self._lock:
+            item = self._cache.get(key)
+            if not item:
+                if not self._func:
+                    return
+                item = self._new_item(key, self._func, self._timeout)
+            else:
+                self._cache.move_to_end(key)
+
+            if not _refresh and item['loaded'] and now - item['last'] < item['timeout']:
+                self.stat_hit += 1
+                return item['data']
+
+            event = item['loading']
+            if event is None:
+                # 由这个调用者更新
+                self.stat_miss += 1
+                item['loading'] = threading.Event()
+            elif item['loaded']:
+                self.stat_stale += 1
+                return item['data']
+
+        if event is None:
+            return self._refresh(key, item, *args, **kwargs)
+
+        # 第一次加载, 等正在加载的调用者完成
+        event.wait()
+        if not item['loaded']:
+            return self(key, _refresh, *args, **kwargs)
+        self.stat_hit += 1
+        return item['data']
+
+# 这是第2种缓存, 用add注册的key不多, 不限制个数
+caches = Cache(maxsize=None)
+# 装饰器用的缓存, 每组参数一个key, 限制个数
+func_caches = Cache()
+
+def _func_key(func, sig, args, kwargs, skip=0):
+    '''按函数和参数生成缓存key, 位置参数和关键字参数的写法不影响key'''
+    try:
+        bound = sig.bind(*args, **kwargs)
+        bound.apply_defaults()
+        args, kwargs = bound.args, bound.kwargs
+    except TypeError:
+        pass
+    return repr((args[skip:], sorted(kwargs.items())))
 
 # 给类方法用的
 def with_cache(timeout):
     def f(func):
-        fpath = os.path.abspath(__file__)
-        funcname = func.__name__
+        funcname = '%s.%s' % (func.__module__, func.__name__)
+        sig = inspect.signature(func)
         def cache_wrap(key, value, info, *args, **kwargs):
             return func(*args, **kwargs)
              
         def _(*args, **kwargs):
             classname = args[0].__class__.__name__
-            key = 'c_%s_%s_%s' % (fpath, classname, funcname)
-            global caches 
-            if not caches.exist(key):
-                caches.add(key, cache_wrap, timeout)
+            key = 'c_%s_%s_%s' % (classname, funcname, _func_key(func, sig, args, kwargs, 1))
+            if not func_caches.exist(key):
+                func_caches.add(key, cache_wrap, timeout, False)
 
-            return caches(key, False, *args, **kwargs)
+            return func_caches(key, False, *args, **kwargs)
         return _
     return f
 
 # 只能给独立的function使用
 def with_cache_func(timeout):
     def f(func):
-        fpath = os.path.abspath(__file__)
-        funcname = func.__name__
+        funcname = '%s.%s' % (func.__module__, func.__qualname__)
+        sig = inspect.signature(func)
         def cache_wrap(key, value, info, *args, **kwargs):
             return func(*args, **kwargs)
              
         def _(*args, **kwargs):
-            key = 'c_%s_%s' % (fpath, funcname)
-            global caches
-            if not caches.exist(key):
-                caches.add(key, cache_wrap, timeout)
-            return caches(key, False, *args, **kwargs)
+            key = 'c_%s_%s' % (funcname, _func_key(func, sig, args, kwargs))
+            if not func_caches.exist(key):
+                func_caches.add(key, cache_wrap, timeout, False)
+            return func_caches(key, False, *args, **kwargs)
         return _
     return f
 
 
 
+# 两级缓存的编码, 有msgpack时用msgpack
+if codec.msgpack:
+    _dumps, _loads = codec.msgpack_dumps, codec.msgpack_loads
+else:
+    _dumps, _loads = codec.dumps, codec.loads
+
+class TieredCache (object):
+    '''进程内缓存(L1)加redis缓存(L2), 多个进程共享L2里的数据.
+    set/delete 时通过redis的pub/sub通知所有进程删除L1里的数据, L1的过期时间是通知丢失时的上限'''
+    def __init__(self, redis_conf, prefix='zc:', timeout=300, l1_timeout=10, maxsize=10000,
+                 channel='zbase3.cache.invalidate'):
+        '''redis_conf - redis连接的配置或者已经建立的连接
+        timeout - L2里数据的过期时间
+        l1_timeout - L1里数据的过期时间'''
+        self.redis_conf = redis_conf
+        self.conn = None if isinstance(redis_conf, dict) else redis_conf
+        self.prefix = prefix
+        self.timeout = timeout
+        self.channel = channel
+        self.l1 = Cache(self._load, l1_timeout, maxsize)
+        # 订阅通知的线程所在的进程, fork之后的子进程要重新启动
+        self._listener_pid = 0
+        self._listener_lock = threading.Lock()
+        self.stat_l2_hit = 0
+        self.stat_load = 0
+        self.stat_invalidate = 0
+
+    def db(self):
+        if not self.conn:
+            self.conn = redispool.get_redis(self.redis_conf)
+        return self.conn
+
+    def _load(self, key, value, info, loader, timeout):
+        '''L1没有时从L2取, L2也没有时调用loader并写入L2'''
+        v = self.db().get(self.prefix + key)
+        if v is not None:
+            self.stat_l2_hit += 1
+            return _loads(v)
+        if loader is None:
+            return None
+        self.stat_load += 1
+        v = _dumps(loader(key))
+        self.db().set(self.prefix + key, v, ex=timeout or self.timeout)
+        # L1里也放解码后的值, 和其他进程从L2取到的类型一样(tuple变list, datetime变str)
+        return _loads(v)
+
+    def get(self, key, loader=None, timeout=None):
+        '''取数据, 都没有时调用 loader(key) 加载, timeout为写入L2的过期时间'''
+        if self._listener_pid != os.getpid():
+            with self._listener_lock:
+                if self._listener_pid != os.getpid():
+                    self._start_listener()
+        return self.l1(key, False, loader, timeout)
+
+    def set(self, key, data, timeout=None):
+        self.db().set(self.prefix + key, _dumps(data), ex=timeout or self.timeout)
+        self.invalidate(key)
+
+    def delete(self, key):
+        self.db().delete(self.prefix + key)
+        self.invalidate(key)
+
+    def invalidate(self, key):
+        '''通知所有进程删除L1里的key'''
+        self.l1.remove(key)
+        self.db().publish(self.channel, key)
+
+    def stat(self):
+        ret = self.l1.stat()
+        ret.update({'l2_hit': self.stat_l2_hit, 'load': self.stat_load, 'invalidate': self.stat_invalidate})
+        return ret
+
+    def _subscribe(self):
+        ps = self.db().pubsub()
+        ps.subscribe(self.channel)
+        return ps
+
+    def _start_listener(self):
+        '''先订阅再返回, 之后的通知不会丢'''
+        self._listener_pid = os.getpid()
+        try:
+            ps = self._subscribe()
+        except Exception:
+            log.warning('cache invalidate subscribe error: %s', traceback.format_exc())
+            ps = None
+        th = threading.Thread(target=self._listen, args=(ps,), name='cache-invalidate', daemon=True)
+        th.start()
+
+    def _listen(self, ps):
+        pid = os.getpid()
+        while self._listener_pid == pid:
+            try:
+                if ps is None:
+                    time.sleep(1)
+                    ps = self._subscribe()
+                    # 重新订阅之前可能丢了通知, 清空L1
+                    self.l1.clear()
+                for msg in ps.listen():
+                    if msg.get('type') != 'message':
+                        continue
+                    key = msg['data']
+                    if isinstance(key, bytes):
+                        key = key.decode('utf-8')
+                    self.l1.remove(key)
+                    self.stat_invalidate += 1
+            except Exception:
+                log.warning('cache invalidate listen error: %s', traceback.format_exc())
+            ps = None
+
+
+class ShmCacheError (Exception):
+    pass
+
+class ShmCacheFull (ShmCacheError):
+    pass
+
+# 读的时候等写进程完成的最长时间(秒), 写进程中途死掉时版本号一直是奇数
+SHM_READ_TIMEOUT = 1
+
+# 共享内存缓存的头部: magic, 槽数, 版本号, key数, 数据区已用到的位置
+SHM_HEADER = struct.Struct('<4sIQQQ')
+# 槽: key的hash, 数据位置(为0表示已删除), key长度, value长度
+SHM_SLOT = struct.Struct('<QQII')
+
+class ShmCache (object):
+    '''多进程共享的只读为主的缓存, 数据放在匿名共享内存里.
+    在主进程fork子进程之前创建并加载数据, 子进程继承同一块内存, 所有进程只有一份数据.
+    只有创建的进程能写(一般是主进程), 其他进程写时抛出ShmCacheError. 写的时候版本号为奇数, 读的时候版本号变了就重读.
+    槽是开放寻址的hash表, 删除后的槽在插入时复用.
+    数据区只追加, 更新或删除key后旧数据的空间不回收, 空间不够时调用compact()整理'''
+    def __init__(self, size=64*1024*1024, slots=65536):
+        self.slots = slots
+        self.data_start = SHM_HEADER.size + SHM_SLOT.size * slots
+        if size <= self.data_start:
+            raise ValueError('shm cache size too small: %d' % size)
+        self.size = size
+        # 匿名的MAP_SHARED内存, fork后父子进程共享
+        self.mm = mmap.mmap(-1, size)
+        self._lock = threading.Lock()
+        # 版本号只在创建的进程里维护, fork出的子进程写会让版本号倒退, 读的时候可能读到写了一半的数据
+        self._pid = os.getpid()
+        self._seq = 0
+        self._write_header(0, 0)
+
+    def _write_header(self, count, used):
+        SHM_HEADER.pack_into(self.mm, 0, b'ZSHM', self.slots, self._seq, count, used or self.data_start)
+
+    def _header(self):
+        return SHM_HEADER.unpack_from(self.mm, 0)
+
+    def _check_writer(self):
+        if os.getpid() != self._pid:
+            raise ShmCacheError('shm cache can only be written by process %d' % self._pid)
+
+    def _hash(self, k):
+        return int.from_bytes(hashlib.blake2b(k, digest_size=8).digest(), 'little') or 1
+
+    def _find(self, k, h):
+        '''返回key所在的槽和槽的内容, 没有时返回第一个已删除的槽或者空槽'''
+        mm = self.mm
+        i = h % self.slots
+        free = None
+        for n in range(self.slots):
+            pos = SHM_HEADER.size + SHM_SLOT.size * i
+            slot = SHM_SLOT.unpack_from(mm, pos)
+            if slot[0] == 0:
+                return free or pos, None
+            if not slot[1]:
+                if free is None:
+                    free = pos
+            elif slot[0] == h and mm[slot[1]:slot[1]+slot[2]] == k:
+                return pos, slot
+            i = (i + 1) % self.slots
+        return free, None
+
+    def _set(self, key, value, count, used):
+        k = key.encode('utf-8')
+        v = _dumps(value)
+        h = self._hash(k)
+        pos, slot = self._find(k, h)
+        if pos is None:
+            raise ShmCacheFull('no free slot, slots=%d' % self.slots)
+        if used + len(k) + len(v) > self.size:
+            raise ShmCacheFull('no free space, size=%d used=%d' % (self.size, used))
+        self.mm[used:used+len(k)+len(v)] = k + v
+        SHM_SLOT.pack_into(self.mm, pos, h, used, len(k), len(v))
+        if slot is None:
+            count += 1
+        return count, used + len(k) + len(v)
+
+    def load(self, items):
+        '''批量写入, items为dict或者(key, value)的列表'''
+        self._check_writer()
+        if isinstance(items, dict):
+            items = items.items()
+        with self._lock:
+            _, _, _, count, used = self._header()
+            self._seq += 1
+            self._write_header(count, used)
+            try:
+                for key, value in items:
+                    count, used = self._set(key, value, count, used)
+            finally:
+                self._seq += 1
+                self._write_header(count, used)
+        return count
+
+    def set(self, key, value):
+        self.load(((key, value),))
+
+    def delete(self, key):
+        self._check_writer()
+        k = key.encode('utf-8')
+        with self._lock:
+            _, _, _, count, used = self._header()
+            pos, slot = self._find(k, self._hash(k))
+            if not slot:
+                return
+            self._seq += 1
+            self._write_header(count, used)
+            # 数据位置置0, 查找时继续往后找
+            SHM_SLOT.pack_into(self.mm, pos, slot[0], 0, 0, 0)
+            self._seq += 1
+            self._write_header(count - 1, used)
+
+    def items(self):
+        '''返回所有的(key, value), 只在写进程里调用'''
+        mm = self.mm
+        ret = []
+        with self._lock:
+            for i in range(self.slots):
+                slot = SHM_SLOT.unpack_from(mm, SHM_HEADER.size + SHM_SLOT.size * i)
+                if slot[1]:
+                    k = bytes(mm[slot[1]:slot[1]+slot[2]]).decode('utf-8')
+                    ret.append((k, _loads(mm[slot[1]+slot[2]:slot[1]+slot[2]+slot[3]])))
+        return ret
+
+    def compact(self):
+        '''回收旧数据和已删除的槽占用的空间, 重新写入所有数据'''
+        self._check_writer()
+        items = self.items()
+        with self._lock:
+            self._seq += 1
+            self._write_header(0, 0)
+            count, used = 0, self.data_start
+            try:
+                self.mm[SHM_HEADER.size:self.data_start] = bytes(self.data_start - SHM_HEADER.size)
+                for key, value in items:
+                    count, used = self._set(key, value, count, used)
+            finally:
+                self._seq += 1
+                self._write_header(count, used)
+        return count
+
+    def clear(self):
+        self._check_writer()
+        with self._lock:
+            self._seq += 1
+            self._write_header(0, 0)
+            self.mm[SHM_HEADER.size:self.data_start] = bytes(self.data_start - SHM_HEADER.size)
+            self._seq += 1
+            self._write_header(0, 0)
+
+    def get(self, key, default=None):
+        k = key.encode('utf-8')
+        h = self._hash(k)
+        deadline = None
+        while True:
+            seq = self._header()[2]
+            if seq % 2:
+                if deadline is None:
+                    deadline = time.time() + SHM_READ_TIMEOUT
+                elif time.time() > deadline:
+                    raise ShmCacheError('shm cache is being written too long, version=%d' % seq)
+                time.sleep(0)
+                continue
+            pos, slot = self._find(k, h)
+            v = self.mm[slot[1]+slot[2]:slot[1]+slot[2]+slot[3]] if slot else None
+            if self._header()[2] == seq:
+                break
+        if v is None:
+            return default
+        return _loads(v)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return self._header()[3]
+
+    def stat(self):
+        _, slots, seq, count, used = self._header()
+        return {'slots': slots, 'count': count, 'size': self.size, 'used': used, 'version': seq}
+
+
 
 def test_2():
     #import inspect
@@ -189,14 +571,16 @@ def test_decorator_class():
 
     for i in range(0, 3):
         v1 = t1.test(str(i))
-        v2 = t2.test(str(i))
-        v21 = t2.test(name=str(i))
+        v2 = t2.test('x')
+        v21 = t2.test(name='x')
 
         print('Test1:', v1)
         print('Test2:', v2)
         print('Test2:', v21)
         
         assert v2 == v21
+        # 参数不同缓存也不同
+        assert t2.test('y') != v2
         
         if i == 1:
             assert v2 == last_v2
@@ -231,14 +615,15 @@ def test_decorator_func():
 
     for i in range(0, 3):
         v1 = test1(str(i))
-        v2 = test2(str(i))
-        v21 = test2(name=str(i))
+        v2 = test2('x')
+        v21 = test2(name='x')
 
         print('Test1:', v1)
         print('Test2:', v2)
         print('Test2:', v21)
         
         assert v2 == v21
+        assert test2('y') != v2
         
         if i == 1:
             assert v2 == last_v2
@@ -254,7 +639,213 @@ def test_decorator_func():
 
         time.sleep(0.1)
 
- 
+
+def test_lru():
+    def func1(key, value, info):
+        return '%s-%.3f' % (key, time.time())
+
+    c = Cache(func1, 10, maxsize=3)
+    for k in ['a', 'b', 'c']:
+        c(k)
+    c('a')
+    c('d')
+    assert not c.exist('b') and c.exist('a') and c.exist('d')
+    st = c.stat()
+    assert st['size'] == 3 and st['evict'] == 1 and st['hit'] == 1 and st['miss'] == 4, st
+
+    # 装饰器的key很多时, 不会淘汰用add注册的key
+    caches.add('lru_name', func1, 10)
+    maxsize, func_caches.maxsize = func_caches.maxsize, 3
+
+    @with_cache_func(10)
+    def square(x):
+        return x * x
+
+    try:
+        assert [square(i) for i in range(10)] == [i * i for i in range(10)]
+        assert len(func_caches._cache) == 3 and caches('lru_name').startswith('lru_name')
+    finally:
+        func_caches.maxsize = maxsize
+        caches.remove('lru_name')
+
+
+def test_single_flight():
+    calls = []
+
+    def func1(key, value, info):
+        calls.append(key)
+        time.sleep(0.1)
+        if len(calls) == 3:
+            raise ValueError('update error')
+        return len(calls)
+
+    c = Cache(func1, 0.2)
+    # 第一次加载时并发的调用者等待同一次加载
+    ts = [threading.Thread(target=c, args=('a',)) for i in range(5)]
+    [t.start() for t in ts]
+    [t.join() for t in ts]
+    assert len(calls) == 1 and c('a') == 1
+
+    # 过期后只有一个调用者更新, 其他的拿到旧数据
+    time.sleep(0.2)
+    ret = []
+    ts = [threading.Thread(target=lambda: ret.append(c('a'))) for i in range(5)]
+    [t.start() for t in ts]
+    [t.join() for t in ts]
+    assert len(calls) == 2 and sorted(ret) == [1, 1, 1, 1, 2] and c.stat()['stale'] == 4
+
+    # 更新出错时继续使用旧数据
+    time.sleep(0.2)
+    assert c('a') == 2 and c.stat()['error'] == 1
+    assert c('a') == 4
+
+
+class FakeRedis (object):
+    '''测试用的redis, 只有两级缓存用到的命令'''
+    def __init__(self):
+        self.data = {}
+        self.subs = []
+        self.cmds = 0
+
+    def get(self, key):
+        self.cmds += 1
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.cmds += 1
+        self.data[key] = value
+
+    def delete(self, key):
+        self.cmds += 1
+        self.data.pop(key, None)
+
+    def publish(self, channel, msg):
+        for q in self.subs:
+            q.put({'type': 'message', 'channel': channel, 'data': msg.encode('utf-8')})
+
+    def pubsub(self):
+        import queue
+        q = queue.Queue()
+        self.subs.append(q)
+
+        class PubSub:
+            def subscribe(self, channel):
+                pass
+
+            def listen(self):
+                while True:
+                    yield q.get()
+        return PubSub()
+
+
+def test_tiered():
+    r = FakeRedis()
+    # 两个进程
+    w1 = TieredCache(r, l1_timeout=10)
+    w2 = TieredCache(r, l1_timeout=10)
+    loads = []
+
+    def loader(key):
+        loads.append(key)
+        return {'key': key, 'v': len(loads)}
+
+    assert w1.get('conf', loader) == {'key': 'conf', 'v': 1}
+    assert w2.get('conf', loader) == {'key': 'conf', 'v': 1}
+    cmds = r.cmds
+    for i in range(100):
+        w1.get('conf', loader)
+        w2.get('conf', loader)
+    assert loads == ['conf'] and r.cmds == cmds and w2.stat()['l2_hit'] == 1
+
+    w1.set('conf', {'v': 'new'})
+    time.sleep(0.05)
+    assert w2.get('conf', loader) == {'v': 'new'} and w2.stat()['invalidate'] >= 1
+
+    w2.delete('conf')
+    time.sleep(0.05)
+    assert w1.get('conf', loader) == {'key': 'conf', 'v': 2} and len(loads) == 2
+
+    # 加载数据的进程和其他进程拿到的类型一样
+    import datetime
+    row = lambda key: {'ids': (1, 2), 'ctime': datetime.datetime(2020, 1, 2, 3, 4, 5)}
+    assert w1.get('row', row) == w2.get('row', row) == {'ids': [1, 2], 'ctime': '2020-01-02 03:04:05'}
+
+    # 并发的第一次调用只启动一个订阅线程
+    w3 = TieredCache(r)
+    subs = len(r.subs)
+    ts = [threading.Thread(target=w3.get, args=('conf',)) for i in range(10)]
+    [t.start() for t in ts]
+    [t.join() for t in ts]
+    assert len(r.subs) == subs + 1
+
+    # 配置相同的共用redispool里的连接
+    conf = {'host': 'fake-tiered', 'port': 6379}
+    redispool.redis_conns[repr(sorted(conf.items()))] = r
+    assert TieredCache(conf).db() is r and TieredCache(dict(conf)).db() is r
+    redispool.redis_conns.clear()
+    print('tiered ok', w1.stat())
+
+def test_shm():
+    c = ShmCache(1024*1024, 1024)
+    # 主进程fork之前加载
+    c.load({'k%d' % i: {'id': i, 'name': '名字%d' % i} for i in range(500)})
+    assert len(c) == 500 and c.get('k7') == {'id': 7, 'name': '名字7'} and c.get('x') is None
+
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        ok = c.get('k499')['id'] == 499
+        # 子进程不能写
+        try:
+            c.set('k1', 'child')
+            ok = False
+        except ShmCacheError:
+            pass
+        os.read(rfd, 1)
+        # 父进程更新之后子进程能看到
+        ok = ok and c.get('k1') == 'new' and c.get('k500') == 500 and c.get('k2') is None
+        os._exit(0 if ok else 1)
+
+    c.set('k1', 'new')
+    c.set('k500', 500)
+    c.delete('k2')
+    os.write(wfd, b'.')
+    _, status = os.waitpid(pid, 0)
+    assert status == 0
+    assert len(c) == 500 and 'k2' not in c and c.get('k3')['id'] == 3
+
+    # 不断地写入删除, 已删除的槽会被复用
+    for i in range(5000):
+        c.set('tmp%d' % i, i)
+        c.delete('tmp%d' % i)
+    assert len(c) == 500 and c.get('tmp1') is None and c.get('k500') == 500
+    used = c.stat()['used']
+    assert c.compact() == 500 and c.stat()['used'] < used and c.get('k3')['id'] == 3
+
+    # 写进程中途死掉, 读的时候不会一直等
+    global SHM_READ_TIMEOUT
+    timeout, SHM_READ_TIMEOUT = SHM_READ_TIMEOUT, 0.05
+    c._seq += 1
+    c._write_header(*c._header()[3:])
+    try:
+        c.get('k3')
+        assert False
+    except ShmCacheError:
+        pass
+    finally:
+        SHM_READ_TIMEOUT = timeout
+        c._seq += 1
+        c._write_header(*c._header()[3:])
+
+    c.clear()
+    assert len(c) == 0 and c.get('k1') is None
+    try:
+        c.load({'big': 'x' * 1024 * 1024})
+        assert False
+    except ShmCacheFull:
+        pass
+    print('shm ok', c.stat())
+
 
 if __name__ == '__main__':
     fs = list(globals().keys())
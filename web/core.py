@@ -3,6 +3,8 @@ import os, sys, uuid, threading
 import re, time, types, mimetypes
 import urllib, urllib.request
 from zbase3.web import template, reloader, session
+from zbase3.web.router import Router
+from zbase3.web.static import StaticFiles
 from zbase3.base import dbpool, logger
 from zbase3.base.logger import REQUEST_ID_MAP
 from zbase3.web.httpcore import Request, Response, NotFound
@@ -118,6 +120,7 @@ class WebApplication(object):
             APPS: app
             URLS: (('/', index.Index), )
             STATICS
+            STATIC_CACHE: {'maxsize':1024, 'check_interval':1}
             SESSION
             MIDDLEWARE
         '''
@@ -147,6 +150,9 @@ class WebApplication(object):
         self.reloader = None
         if self.debug:
             self.reloader = reloader.Reloader()
+
+        # STATIC_CACHE: {'maxsize':1024, 'check_interval':1}
+        self.static_files = StaticFiles(**getattr(settings, 'STATIC_CACHE', {}))
        
 
     def add_urls(self, urls, appname=''):
@@ -159,18 +165,17 @@ class WebApplication(object):
             else:
                 obj = item[1]
 
-            urlpath = item[0]
+            urlpath = item[0].lstrip('^').rstrip('$')
             if appname:
-                urlpath = '^/' + appname + urlpath.lstrip('^').rstrip('$') + '$'
-            else:
-                urlpath = '^' + urlpath.lstrip('^').rstrip('$') + '$'
+                urlpath = '/' + appname + urlpath
 
-            log.debug('url: %s %s', urlpath, item[1])
+            log.debug('url: ^%s$ %s', urlpath, item[1])
             if len(item) == 2:
-                tmpurls.append((re.compile(urlpath), obj, {}))
+                route = self.router.add(urlpath, obj, {})
             else:
-                tmpurls.append((re.compile(urlpath), obj, item[2]))
-        
+                route = self.router.add(urlpath, obj, item[2])
+            tmpurls.append((route.regex, obj, route.kwargs))
+
         #self.urls = tmpurls + self.urls
         self.urls += tmpurls
 
@@ -197,6 +202,7 @@ class WebApplication(object):
             dbpool.install(self.settings.DATABASE)
 
         self.urls = []
+        self.router = Router()
         if hasattr(self.settings, 'APP_PATH'):
             log.debug('APP_PATH: %s', self.settings.APP_PATH)
             if self.settings.APP_PATH and os.path.isdir(self.settings.APP_PATH):
@@ -251,63 +257,59 @@ class WebApplication(object):
                 for k,v in self.settings.STATICS.items():
                     if rpath.startswith(k):
                         fpath = fpath.replace(k,v)
-                        if os.path.isfile(fpath):
-                            resp = self.static_file(req, fpath)
-                        else:
-                            resp = NotFound('Not Found')
+                        resp = self.static_file(req, fpath)
                         break
             else:
                 # 匹配url
-                for regex, view, kwargs in self.urls:
-                    match = regex.match(rpath)
-                    if match is not None:
-                        if req.method not in self.allowed_methods:
-                            raise NotImplemented
-                        args    = ()
-                        kw = {}
-                        kw.update(kwargs)
-                        mkwargs = match.groupdict()
-                        if mkwargs:
-                            kw.update(mkwargs)
-                        else:
-                            args = match.groups()
-                        #log.debug('url match:%s %s', args, kwargs)
-
-                        times.append(time.time())
-                        viewobj = view(self, req)
-
-                        middleware = []
-                        try:
-                            viewobj.initial()
-                            viewobj.allowed_methods = self.allowed_methods
-
-                            if hasattr(self.settings, 'MIDDLEWARE'):
-                                for x in self.settings.MIDDLEWARE:
-                                    obj = x()
-                                    resp = obj.before(viewobj, *args, **kw)
-                                    if resp:
-                                        log.debug('middleware before:%s', resp)
-                                        break
-                                    middleware.append(obj)
-
-                            ret = getattr(viewobj, req.method)(*args, **kw)
-                            if ret:
-                                if isinstance(ret, (str, bytes)) and not viewobj.resp.content: 
-                                    viewobj.resp.write(ret)
-                                elif isinstance(ret, Response):
-                                    viewobj.resp = ret
-
-                            for obj in middleware:
-                                resp = obj.after(viewobj)
-                                log.debug('middleware after:%s', resp)
-
-                            viewobj.finish()
-
-                        except HandlerFinish as e:
-                            if not viewobj.resp.content:
-                                viewobj.resp.result(e.code, e.value)
-                        resp = viewobj.resp
-                        break
+                route, match = self.router.match(rpath)
+                if route is not None:
+                    if req.method not in self.allowed_methods:
+                        raise NotImplemented
+                    view = route.view
+                    args    = ()
+                    kw = {}
+                    kw.update(route.kwargs)
+                    mkwargs = match.groupdict()
+                    if mkwargs:
+                        kw.update(mkwargs)
+                    else:
+                        args = match.groups()
+                    #log.debug('url match:%s %s', args, kwargs)
+
+                    times.append(time.time())
+                    viewobj = view(self, req)
+
+                    middleware = []
+                    try:
+                        viewobj.initial()
+                        viewobj.allowed_methods = self.allowed_methods
+
+                        if hasattr(self.settings, 'MIDDLEWARE'):
+                            for x in self.settings.MIDDLEWARE:
+                                obj = x()
+                                resp = obj.before(viewobj, *args, **kw)
+                                if resp:
+                                    log.debug('middleware before:%s', resp)
+                                    break
+                                middleware.append(obj)
+
+                        ret = getattr(viewobj, req.method)(*args, **kw)
+                        if ret:
+                            if isinstance(ret, (str, bytes)) and not viewobj.resp.content: 
+                                viewobj.resp.write(ret)
+                            elif isinstance(ret, Response):
+                                viewobj.resp = ret
+
+                        for obj in middleware:
+                            resp = obj.after(viewobj)
+                            log.debug('middleware after:%s', resp)
+
+                        viewobj.finish()
+
+                    except HandlerFinish as e:
+                        if not viewobj.resp.content:
+                            viewobj.resp.result(e.code, e.value)
+                    resp = viewobj.resp
                 else:
                     resp = NotFound('Not Found')
         except Exception as e:
@@ -328,10 +330,12 @@ class WebApplication(object):
         try:
             if req.query_string:
                 s.append(req.query_string[:1024])
-            if req.method in ('POST', 'PUT'):
-                s.append(str(req.input())[:1024])
-            if not req.input() and req.data:
-                s.append(str(req.data)[:1024])
+            # 只记录处理请求时已经解析或者读取的数据, 不为了日志去读请求体
+            input, data = req.parsed()
+            if req.method in ('POST', 'PUT') and input:
+                s.append(str(input)[:1024])
+            if not input and data:
+                s.append(str(data)[:1024])
             # if resp.content and resp.headers['Content-Type'].startswith('application/json'):
             if resp.content and resp.content[0] == 123 and resp.content[-1] == 125:  # json, start { end }
                 s.append(str(resp.content)[:1024])
@@ -343,34 +347,5 @@ class WebApplication(object):
         return resp(environ, start_response)
 
     def static_file(self, req, fpath):
-        mtype, encoding = mimetypes.guess_type(fpath)
-        if not mtype:
-            mtype = 'application/octet-stream'
-
-        try:
-            reqtm = 0
-            reqgmt = req.environ.get('HTTP_IF_MODIFIED_SINCE')
-            if reqgmt:
-                reqgmt = reqgmt[:reqgmt.find('GMT') + 3]
-                reqtm  = time.strptime(reqgmt, '%a, %d %b %Y %H:%M:%S GMT')
-                if type(reqtm) != float:
-                    reqtm = time.mktime(reqtm) + (time.mktime(time.localtime()) - time.mktime(time.gmtime()))
-        except:
-            log.warn(traceback.format_exc())
-            reqtm  = 0
-
-        mtime = os.path.getmtime(fpath)
-        gmt   = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(mtime))
-        if mtime > reqtm or mtype == 'application/octet-stream':
-            with open(fpath, 'rb') as f:
-                s = f.read()
-            resp = Response(s, mimetype=mtype)
-        else:
-            resp = Response('', status=304, mimetype=mtype)
-        resp.headers['Last-Modified'] = gmt
-
-        return resp
-
-
-
-
+        '''静态文件, 文件不存在返回404'''
+        return self.static_files(req, fpath)
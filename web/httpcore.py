@@ -1,7 +1,7 @@
 # coding: utf-8
 import cgi
-import json
 import urllib
+import urllib.parse
 import logging
 import time
 import http
@@ -9,8 +9,11 @@ import types
 import datetime
 from http import cookies
 import traceback
+from zbase3.base import codec
 #from io import StringIO
 import io
+import tempfile
+import os
 
 log = logging.getLogger()
 
@@ -87,9 +90,195 @@ class MyFieldStorage (cgi.FieldStorage):
 
 
 
+def parse_header(line):
+    '''解析 Content-Type/Content-Disposition 之类的头, 返回 (值, {参数})'''
+    parts = line.split(';')
+    key = parts[0].strip().lower()
+    pdict = {}
+    for p in parts[1:]:
+        i = p.find('=')
+        if i < 0:
+            continue
+        name = p[:i].strip().lower()
+        value = p[i+1:].strip()
+        if len(value) >= 2 and value[0] == value[-1] == '"':
+            value = value[1:-1].replace('\\\\', '\\').replace('\\"', '"')
+        pdict[name] = value
+    return key, pdict
+
+
+class LimitedReader(object):
+    '''最多只读取length字节的输入流'''
+    def __init__(self, fp, length):
+        self.fp = fp
+        self.todo = length
+
+    def read(self, size=-1):
+        if self.todo <= 0:
+            return b''
+        if size < 0 or size > self.todo:
+            size = self.todo
+        data = self.fp.read(size)
+        self.todo -= len(data)
+        return data
+
+
+class MultipartField(object):
+    '''multipart/form-data 的一个字段, 和cgi.FieldStorage一样有 name/filename/type/file/value'''
+    def __init__(self, name, filename, ctype, headers, file):
+        self.name = name
+        self.filename = filename
+        self.type = ctype
+        self.headers = headers
+        self.file = file
+
+    @property
+    def value(self):
+        self.file.seek(0)
+        v = self.file.read()
+        self.file.seek(0)
+        if self.filename is None:
+            return v.decode('utf-8', 'replace')
+        return v
+
+    def __repr__(self):
+        return '<MultipartField %s %s>' % (self.name, self.filename)
+
+
+class FormStorage(object):
+    '''流式解析后的表单, 接口和cgi.FieldStorage一样'''
+    def __init__(self, fields):
+        self.list = fields
+
+    def keys(self):
+        return list(dict.fromkeys(f.name for f in self.list))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self, key):
+        return any(f.name == key for f in self.list)
+
+    def __getitem__(self, key):
+        found = [f for f in self.list if f.name == key]
+        if not found:
+            raise KeyError(key)
+        if len(found) == 1:
+            return found[0]
+        return found
+
+    def getvalue(self, key, default=None):
+        if key not in self:
+            return default
+        v = self[key]
+        if isinstance(v, list):
+            return [x.value for x in v]
+        return v.value
+
+    def getfirst(self, key, default=None):
+        for f in self.list:
+            if f.name == key:
+                return f.value
+        return default
+
+    def getlist(self, key):
+        return [f.value for f in self.list if f.name == key]
+
+
+class MultipartParser(object):
+    '''流式的 multipart/form-data 解析, 按块读取, 字段内容超过 spool_size 的写到临时文件里'''
+    block_size = 65536
+
+    def __init__(self, fp, boundary, spool_size=1024*1024):
+        self.fp = fp
+        self.boundary = boundary.encode('latin-1') if isinstance(boundary, str) else boundary
+        self.spool_size = spool_size
+
+    def _make_file(self):
+        return tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+
+    def parse(self):
+        fields = []
+        delim = b'--' + self.boundary
+        buf = b''
+        eof = False
+
+        def fill(buf):
+            data = self.fp.read(self.block_size)
+            return buf + data, not data
+
+        # 跳过第一个分隔符前的内容
+        while True:
+            pos = buf.find(delim)
+            if pos >= 0:
+                buf = buf[pos+len(delim):]
+                break
+            if eof:
+                return fields
+            buf = buf[-len(delim):]
+            buf, eof = fill(buf)
+
+        # 分隔符后面是 -- 表示结束, \r\n 表示后面还有字段
+        sep = b'\r\n' + delim
+        while True:
+            while len(buf) < 2 and not eof:
+                buf, eof = fill(buf)
+            if buf[:2] != b'\r\n':
+                break
+            buf = buf[2:]
+
+            # 字段头
+            while True:
+                pos = buf.find(b'\r\n\r\n')
+                if pos >= 0:
+                    break
+                if eof:
+                    return fields
+                buf, eof = fill(buf)
+            headers = {}
+            for ln in buf[:pos].decode('utf-8', 'replace').split('\r\n'):
+                if ':' in ln:
+                    k, v = ln.split(':', 1)
+                    headers[k.strip().lower()] = v.strip()
+            buf = buf[pos+4:]
+
+            disp, pdict = parse_header(headers.get('content-disposition', ''))
+            ctype = parse_header(headers.get('content-type', 'text/plain'))[0]
+            f = self._make_file()
+
+            # 字段内容, 保留分隔符长度的尾部防止分隔符被切开
+            while True:
+                pos = buf.find(sep)
+                if pos >= 0:
+                    f.write(buf[:pos])
+                    buf = buf[pos+len(sep):]
+                    break
+                if eof:
+                    f.write(buf)
+                    buf = b''
+                    break
+                keep = len(sep) - 1
+                if len(buf) > keep:
+                    f.write(buf[:-keep])
+                    buf = buf[-keep:]
+                buf, eof = fill(buf)
+
+            f.seek(0)
+            fields.append(MultipartField(pdict.get('name'), pdict.get('filename'), ctype, headers, f))
+
+        return fields
+
+
 class Request(object):
     _input = None
     _files = None
+    # multipart 字段超过这个大小写到临时文件
+    spool_size = 1024*1024
+    # multipart 请求体直接从输入流解析, 不保留原始数据. 需要 req.data 的应用可以设为False
+    stream_multipart = True
 
     def __init__(self, environ):
 
@@ -97,31 +286,90 @@ class Request(object):
         # FIXME: 兼容部分app提交header错误的处理
         if 'CONTENT_TYPE' in self.environ and self.environ['CONTENT_TYPE'] == 'application/x-www-form-urlencoded,application/x-www-form-urlencoded; charset=UTF-8':
             self.environ['CONTENT_TYPE'] = 'application/x-www-form-urlencoded; charset=UTF-8'
-        # 处理query_string 为cgi提供安全数据
-        safe_environ = {'QUERY_STRING':''}
-        for key in ('REQUEST_METHOD', 'CONTENT_TYPE', 'CONTENT_LENGTH'):
-            if key in self.environ: safe_environ[key] = self.environ[key]
         self.method  = environ.get('REQUEST_METHOD', '')
         self.path    = environ.get('PATH_INFO', '')
         self.host    = environ.get('HTTP_HOST', '')
         self.cookie  = {}
         self.query_string = environ.get('QUERY_STRING', '')
         self.length  = int(environ.get('CONTENT_LENGTH') or '0')
-        if self.length:
-            self.data = environ['wsgi.input'].read(self.length)
-        else:
-            self.data = b''
+        self.content_type, self.content_options = parse_header(environ.get('CONTENT_TYPE', ''))
+
+        # 请求体在第一次使用的时候才读取
+        self._data = None
+        # multipart 请求体直接从输入流解析，不保存原始数据
+        self._streamed = False
+        self._form = None
+        self._storage = None
 
         self._parse_cookie()
         
         self._headers = {}
 
-        if self.method != 'OPTIONS':
-            #log.debug('req data:%s %s', self.data, type(self.data))
-            #self.storage = cgi.FieldStorage(fp=StringIO(self.data.decode('utf-8')), environ=safe_environ, keep_blank_values=True)
-            self.storage = MyFieldStorage(fp=io.BytesIO(self.data), environ=safe_environ, keep_blank_values=True)
-        else:
-            self.storage = None
+    @property
+    def streamed(self):
+        '''multipart 请求体是否已经从输入流解析, 是的话 data 为空'''
+        return self._streamed
+
+    @property
+    def data(self):
+        '''原始请求体. multipart请求在input()/files()里流式解析后不保留原始数据, 返回b''.
+        需要原始数据时在解析之前访问data, 或者设置 stream_multipart = False'''
+        if self._data is None:
+            if self._streamed:
+                log.warning('multipart body already parsed from stream, raw data not kept: %s', self.path)
+                self._data = b''
+            elif self.length:
+                self._data = self.environ['wsgi.input'].read(self.length)
+            else:
+                self._data = b''
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    @property
+    def storage(self):
+        '''兼容原来的 cgi.FieldStorage 对象, 只有用到时才创建'''
+        if self._storage is None and self.method != 'OPTIONS':
+            if self.content_type == 'multipart/form-data':
+                # 使用流式解析的结果, 不再读原始数据
+                self._storage = FormStorage(self._parse_form())
+                return self._storage
+            # 处理query_string 为cgi提供安全数据
+            safe_environ = {'QUERY_STRING':''}
+            for key in ('REQUEST_METHOD', 'CONTENT_TYPE', 'CONTENT_LENGTH'):
+                if key in self.environ: safe_environ[key] = self.environ[key]
+            data = self.data
+            safe_environ['CONTENT_LENGTH'] = str(len(data))
+            self._storage = MyFieldStorage(fp=io.BytesIO(data), environ=safe_environ, keep_blank_values=True)
+        return self._storage
+
+    def _parse_form(self):
+        '''解析表单，返回字段列表。json等其他类型的请求体不解析'''
+        if self._form is not None:
+            return self._form
+        self._form = []
+        if self.method in ('GET', 'HEAD', 'OPTIONS') or not self.length:
+            return self._form
+
+        if self.content_type == 'multipart/form-data':
+            boundary = self.content_options.get('boundary')
+            if not boundary:
+                return self._form
+            if self._data is None and self.stream_multipart:
+                fp = LimitedReader(self.environ['wsgi.input'], self.length)
+                self._streamed = True
+            else:
+                fp = io.BytesIO(self._data)
+            self._form = MultipartParser(fp, boundary, self.spool_size).parse()
+        elif self.content_type == 'application/x-www-form-urlencoded' or \
+                (not self.content_type and self.method == 'POST'):
+            # 和cgi一样，POST没有Content-Type时按表单处理
+            qs = self.data.decode('utf-8', 'replace')
+            for k, v in urllib.parse.parse_qsl(qs, keep_blank_values=True):
+                self._form.append(MultipartField(k, None, '', {}, io.BytesIO(v.encode('utf-8'))))
+        return self._form
 
     def _parse_cookie(self):
         cookiestr = self.environ.get('HTTP_COOKIE', '')
@@ -174,30 +422,37 @@ class Request(object):
         if self._input:
             return self._input
         data = self._parse_query_string()
-        if self.storage is not None  and self.storage.list:
-            for k in self.storage.list:
+        if self.content_type != 'application/json':
+            for k in self._parse_form():
                 if k.filename:
                     data[k.name] = k.file
                 else:
                     data[k.name] = k.value
         self._input = data
-        if jsondata and self.data:
+        # 只有json的请求体才检查, 表单等其他类型不读原始数据
+        if jsondata and self.length and (self.content_type == 'application/json' or self.content_type.endswith('+json')):
             #d = self.data.decode('utf-8').strip()
             if self.data[0:1] == b'{' and self.data[-1:] == b'}':
-                obj = json.loads(self.data)
+                obj = codec.loads(self.data)
                 self._input.update(obj)
         return self._input
 
     def postdata(self):
+        '''原始请求体, 流式解析过的multipart请求返回空'''
         return self.data
 
+    def parsed(self):
+        '''已经解析的参数和已经读取的原始请求体 (input, data), 没有时为None.
+        不会读取请求体, 日志里用, 不影响multipart的流式解析'''
+        return self._input, self._data
+
     def inputjson(self):
         data = self.input()
-        if self.storage is not None:
-            postdata = self.storage.value
-            if postdata and postdata[0:1] == '{' and postdata[-1:] == '}':
+        if self.method != 'OPTIONS' and self.content_type not in ('multipart/form-data', 'application/x-www-form-urlencoded'):
+            postdata = self.data
+            if postdata and postdata[0:1] == b'{' and postdata[-1:] == b'}':
                 try:
-                    obj = json.loads(postdata)
+                    obj = codec.loads(postdata)
                     data.update(obj)
                     self._input = data
                 except Exception as e:
@@ -208,11 +463,10 @@ class Request(object):
         if self._files:
             return self._files
         data = []
-        if self.storage is not None and self.storage.list:
-            for k in self.storage.list:
-                if k.filename:
-                    data.append(k)
-                    k.file.seek(0)
+        for k in self._parse_form():
+            if k.filename:
+                data.append(k)
+                k.file.seek(0)
         self._files = data
         return self._files
 
@@ -334,6 +588,55 @@ class ChunkedResponse(Response):
             log.warn(traceback.format_exc())
 
 
+class FileResponse(Response):
+    """文件下载的 response, 不把文件读到内存里.
+    服务器提供了 wsgi.file_wrapper 时交给服务器发送(一般会用 sendfile), 否则按块读取返回.
+    offset/length 用来支持 Range 请求.
+    """
+    block_size = 65536
+
+    def __init__(self, fpath, offset=0, length=0, status=200, mimetype='application/octet-stream', charset='utf-8'):
+        super(FileResponse, self).__init__(b'', status, mimetype, charset)
+        self.fpath = fpath
+        self.offset = offset
+        self.file_length = length
+
+    def length(self):
+        return self.file_length
+
+    def _read_blocks(self, f):
+        try:
+            f.seek(self.offset)
+            todo = self.file_length
+            while todo > 0:
+                data = f.read(min(todo, self.block_size))
+                if not data:
+                    break
+                todo -= len(data)
+                yield data
+        finally:
+            f.close()
+
+    def __call__(self, environ, start_response):
+        statusstr = '%d %s' % (self.status, HTTP_STATUS_CODES.get(self.status, ''))
+        self.headers['Content-Length'] = str(self.file_length)
+
+        headers = list(self.headers.items())
+        if self.cookies:
+            for c in self.cookies.values():
+                headers.append(('Set-Cookie', c.OutputString()))
+        start_response(statusstr, headers)
+
+        if environ.get('REQUEST_METHOD') == 'HEAD' or not self.file_length:
+            return [b'']
+
+        f = open(self.fpath, 'rb')
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper and self.offset == 0 and self.file_length == os.fstat(f.fileno()).st_size:
+            return file_wrapper(f, self.block_size)
+        return self._read_blocks(f)
+
+
 def NotFound(s=None):
     if not s:
         return Response(HTTP_STATUS_CODES[404], 404)
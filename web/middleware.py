@@ -41,8 +41,11 @@ class DEBUGMiddleware:
         for k,v in viewobj.req.headers().items():
             log.debug('>> %s:%s',k,v)
         #body
-        if viewobj.req.storage is not None:
-            log.debug('=> %s',viewobj.req.storage.value)
+        input, data = viewobj.req.parsed()
+        if data:
+            log.debug('=> %s', data)
+        elif input:
+            log.debug('=> %s', input)
 
         #RESPONSE
         log.debug('<< %s', viewobj.resp.status)
@@ -0,0 +1,285 @@
+# coding: utf-8
+import re
+import time
+import logging
+
+log = logging.getLogger()
+
+# 正则中的特殊字符，出现这些字符(未转义)的url认为是带参数的
+REGEX_META = set('.^$*+?{}[]|()')
+# 量词，前面的一个字符不能算到固定前缀里
+REGEX_QUANT = set('?*{+')
+# 有反向引用的正则不能合并
+UNCOMBINABLE = re.compile(r'\(\?P=|\\[1-9]')
+
+
+def literal_prefix(pattern):
+    '''返回url正则开头的固定文本部分, 如果整个正则都是固定文本返回 (文本, True)'''
+    ret = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '\\':
+            # \d \w 之类的是字符类, 不是文本
+            if i + 1 >= n or pattern[i+1].isalnum():
+                break
+            c = pattern[i+1]
+            step = 2
+        elif c in REGEX_META:
+            break
+        else:
+            step = 1
+        if i + step < n and pattern[i+step] in REGEX_QUANT:
+            break
+        ret.append(c)
+        i += step
+    else:
+        return ''.join(ret), True
+
+    # 有顶层的 | 时没有固定前缀
+    depth = 0
+    escape = False
+    for c in pattern:
+        if escape:
+            escape = False
+        elif c == '\\':
+            escape = True
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and depth == 0:
+            return '', False
+    return ''.join(ret), False
+
+
+class Route (object):
+    def __init__(self, index, pattern, view, kwargs):
+        self.index = index
+        # 去掉了^和$的正则内容
+        self.pattern = pattern
+        self.regex = re.compile('^' + pattern + '$')
+        self.view = view
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return '<Route %d %s %s>' % (self.index, self.pattern, self.view)
+
+
+class RouteNode (object):
+    '''按url的路径段组成的前缀树节点，保存固定前缀正好到这一段的带参数url'''
+    def __init__(self):
+        self.children = {}
+        self.routes = []
+        self.combined = None
+        # 合并正则的分组序号 => Route
+        self.group_route = {}
+        # 无法合并的正则url，只能逐个匹配
+        self.linear = []
+
+    def compile(self):
+        '''把节点上的url合并成一个正则, 每个url在外层套一个分组，用lastindex找到匹配的url'''
+        parts = []
+        group_route = {}
+        linear = []
+        group = 1
+        for route in self.routes:
+            if UNCOMBINABLE.search(route.pattern):
+                linear.append(route)
+                continue
+            # 合并后的正则里不能有重复的分组名字，这里去掉名字，匹配到后再用原来的正则取参数
+            parts.append('(%s)' % re.sub(r'\(\?P<[^>]+>', '(', route.pattern))
+            group_route[group] = route
+            group += 1 + route.regex.groups
+
+        self.combined = None
+        if parts:
+            try:
+                self.combined = re.compile('^(?:%s)$' % '|'.join(parts))
+            except re.error:
+                log.info('router combine regex error, use linear match')
+                linear = list(self.routes)
+                group_route = {}
+        self.group_route = group_route
+        self.linear = linear
+
+        for node in self.children.values():
+            node.compile()
+
+    def match(self, path):
+        found = None
+        if self.combined is not None:
+            m = self.combined.match(path)
+            if m is not None:
+                found = self.group_route[m.lastindex]
+        for route in self.linear:
+            if found is not None and route.index > found.index:
+                break
+            if route.regex.match(path) is not None:
+                found = route
+                break
+        return found
+
+
+class Router (object):
+    '''url路由。
+    纯文本的url放在字典里直接查找，带参数的url按固定前缀放到前缀树里，
+    同一个节点上的url合并成一个正则一次匹配。
+    多个url都能匹配时，和原来一样以先添加的为准
+    '''
+    def __init__(self):
+        self.routes = []
+        # 纯文本url {path: Route}
+        self._exact = {}
+        self._root = RouteNode()
+        self._regex_count = 0
+        self._dirty = False
+
+        # 路由查找的统计
+        self.lookups = 0
+        self.lookup_time = 0.0
+        self.lookup_max = 0.0
+
+    def __len__(self):
+        return len(self.routes)
+
+    def add(self, pattern, view, kwargs=None):
+        '''pattern为url正则, 不带^和$'''
+        route = Route(len(self.routes), pattern, view, kwargs or {})
+        self.routes.append(route)
+
+        prefix, is_literal = literal_prefix(pattern)
+        if is_literal:
+            # 同样的url以先添加的为准
+            if prefix not in self._exact:
+                self._exact[prefix] = route
+            return route
+
+        # 只用完整的路径段做前缀, /v1/item(\d+) 的前缀为 /v1/
+        node = self._root
+        for seg in prefix.split('/')[:-1]:
+            child = node.children.get(seg)
+            if child is None:
+                child = node.children[seg] = RouteNode()
+            node = child
+        node.routes.append(route)
+        self._regex_count += 1
+        self._dirty = True
+        return route
+
+    def _find(self, path):
+        if self._dirty:
+            self._root.compile()
+            self._dirty = False
+
+        found = self._exact.get(path)
+
+        node = self._root
+        segs = path.split('/')
+        i = 0
+        n = len(segs) - 1
+        while node is not None:
+            if node.routes and (found is None or node.routes[0].index < found.index):
+                route = node.match(path)
+                if route is not None and (found is None or route.index < found.index):
+                    found = route
+            if i >= n:
+                break
+            node = node.children.get(segs[i])
+            i += 1
+
+        return found
+
+    def match(self, path):
+        '''返回 (Route, match对象)，没有找到返回 (None, None)'''
+        start = time.time()
+        route = self._find(path)
+        m = None
+        if route is not None:
+            m = route.regex.match(path)
+
+        t = time.time() - start
+        self.lookups += 1
+        self.lookup_time += t
+        if t > self.lookup_max:
+            self.lookup_max = t
+        return route, m
+
+    def stat(self):
+        '''路由查找耗时统计, 时间单位为微秒'''
+        avg = 0
+        if self.lookups:
+            avg = int(self.lookup_time / self.lookups * 1000000)
+        return {
+            'routes': len(self.routes),
+            'exact': len(self._exact),
+            'regex': self._regex_count,
+            'lookups': self.lookups,
+            'avg': avg,
+            'max': int(self.lookup_max * 1000000),
+        }
+
+    def clear_stat(self):
+        self.lookups = 0
+        self.lookup_time = 0.0
+        self.lookup_max = 0.0
+
+
+def test_match():
+    r = Router()
+    r.add('/', 'index')
+    r.add('/v1/(?P<name>\w+)', 'api')
+    r.add('/v1/ping', 'ping')
+    r.add('/static/a\.js', 'js')
+    r.add('/item/(\d+)/(\d+)', 'item')
+    r.add('/item/(\d+)/(?P<x>[a-z]+)', 'item2')
+
+    route, m = r.match('/')
+    assert route.view == 'index'
+
+    # 先添加的正则优先
+    route, m = r.match('/v1/ping')
+    assert route.view == 'api' and m.groupdict() == {'name': 'ping'}
+
+    route, m = r.match('/static/a.js')
+    assert route.view == 'js'
+
+    route, m = r.match('/static/aXjs')
+    assert route is None
+
+    route, m = r.match('/item/12/34')
+    assert route.view == 'item' and m.groups() == ('12', '34')
+
+    route, m = r.match('/item/12/ab')
+    assert route.view == 'item2' and m.groupdict() == {'x': 'ab'}
+
+    # 可选的 / 不能算到前缀里
+    r.add('/opt/?', 'opt')
+    route, m = r.match('/opt')
+    assert route.view == 'opt'
+
+    r.add('/a(?P<x>\w+)/(?P=x)', 'backref')
+    route, m = r.match('/ab/b')
+    assert route.view == 'backref'
+
+    print(r.stat())
+
+
+def test_perf(n=1000, count=100000):
+    r = Router()
+    for i in range(0, n):
+        r.add('/v1/api%d' % i, 'api%d' % i)
+        r.add('/v2/obj%d/(?P<id>\d+)' % i, 'obj%d' % i)
+
+    paths = ['/v1/api%d' % (n-1), '/v2/obj%d/123' % (n-1), '/notfound']
+    for p in paths:
+        r.clear_stat()
+        for i in range(0, count):
+            r.match(p)
+        print(p, r.stat())
+
+
+if __name__ == '__main__':
+    test_match()
+    test_perf()
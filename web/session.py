@@ -1,18 +1,60 @@
 # coding: utf-8
 import base64
-import datetime
-import json
 import logging
 import os
 import random
+import threading
 import time
 import uuid
-from collections import UserDict
+from collections import UserDict, OrderedDict
+from zbase3.base import codec
 
 log = logging.getLogger()
 
-# session refresh record. {date: {sid:time}}
-session_refresh = {}
+
+
+class RefreshCache(object):
+    '''记录每个session最后刷新过期时间的时间, 按时间先后排列.
+    超过ttl秒的记录和超过maxsize条时最早的记录会被删掉, 占用的内存是固定的'''
+    def __init__(self, maxsize=100000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _expire(self, now):
+        # 调用时要持有锁
+        c = self._cache
+        while c and (len(c) > self.maxsize or now - next(iter(c.values())) > self.ttl):
+            c.popitem(last=False)
+
+    def update(self, sid, now=None):
+        now = now or time.time()
+        with self._lock:
+            self._cache[sid] = now
+            self._cache.move_to_end(sid)
+            self._expire(now)
+
+    def check(self, sid, refresh_time, now=None):
+        '''距离上次刷新超过refresh_time秒返回True, 并记录这次刷新'''
+        now = now or time.time()
+        with self._lock:
+            t = self._cache.get(sid)
+            if t is not None and now - t <= refresh_time:
+                return False
+            self._cache[sid] = now
+            self._cache.move_to_end(sid)
+            self._expire(now)
+        return True
+
+
+# session refresh record. {sid:time}
+session_refresh = RefreshCache()
+
+from zbase3.base.redispool import get_redis, redis_conns
 
 
 class SessionError(Exception):
@@ -21,15 +63,34 @@ class SessionError(Exception):
 
 class Session(UserDict):
     def __init__(self, sid=None, expire=3600, refresh_time=300):
+        self._loaded = True
+        # 加载时的编码结果, 保存时没变化就不写
+        self._orig = None
         UserDict.__init__(self)
         self.sid = sid
         self._changed = False
         self._refresh_time = refresh_time
         if sid:
-            self._load()
+            # 第一次读数据时才加载
+            self._loaded = False
         else:
             self._create_sid()
 
+    @property
+    def data(self):
+        if not self._loaded:
+            self._loaded = True
+            self._load()
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    def __bool__(self):
+        # 有sid就认为session存在, 不能用UserDict的len, 会加载数据
+        return bool(self.sid)
+
     def __setitem__(self, key, item):
         self._changed = True
         self.data[key] = item
@@ -57,58 +118,34 @@ class Session(UserDict):
         pass
 
     def _check_refresh(self):
-        global session_refresh
-        now = datetime.datetime.now()
-        ts = int(now.timestamp())
-        k1 = '%d%02d%02d' % (now.year, now.month, now.day)
-        yestoday = now - datetime.timedelta(days=1)
-        k0 = '%d%02d%02d' % (yestoday.year, yestoday.month, yestoday.day)
-
-        if k0 in session_refresh:
-            session_refresh.pop(k0)
-
-        v = session_refresh.get(k1)
-        if not v:
-            session_refresh[k1] = {self.sid: ts}
-            return True
-
-        t = v.get(self.sid)
-        if not t:
-            v[self.sid] = ts
-            return True
-
-        if ts - t > self._refresh_time:
-            v[self.sid] = ts
-            return True
-
-        # no need refresh
-        return False
+        return session_refresh.check(self.sid, self._refresh_time)
 
     def _update_refresh_cache(self):
-        global session_refresh
-        now = datetime.datetime.now()
-        ts = int(now.timestamp())
-        k1 = '%d%02d%02d' % (now.year, now.month, now.day)
-
-        v = session_refresh.get(k1)
-        if not v:
-            session_refresh[k1] = {self.sid: ts}
-        else:
-            v[self.sid] = ts
-
-        log.debug('update refresh cache: %s %s %d', k1, self.sid, ts)
+        session_refresh.update(self.sid)
+        log.debug('update refresh cache: %s', self.sid)
 
     def save(self):
         pass
 
+    def _is_changed(self):
+        '''和加载时的数据比较, 也能发现修改了里面的list/dict'''
+        if self._orig is None:
+            return self._changed
+        return codec.dumps(self._data) != self._orig
+
     def auto_save(self):
+        if not self._loaded and not self._changed:
+            # 没有读过session, 不用加载, 只刷新过期时间
+            self.refresh()
+            return True
+
         if not self.data:
             if self._changed:
                 self.remove()
             # not have session
             return False
 
-        if self._changed:
+        if self._is_changed():
             self.save()
         else:
             self.refresh()
@@ -122,108 +159,133 @@ class Session(UserDict):
         pass
 
 
-try:
-    import redis
-
-
-    class SessionRedis(Session):
-        def __init__(self, sid=None, expire=3600, config=None):
-            self.redis_conf = config.get('redis_conf')
-            # self.db = config['db']
-            # self.conn = redis.Redis(host=addr[0], port=addr[1], socket_timeout=timeout, db=db)
-            self.conn = None
-            refresh_time = config.get('refresh_time', 300)
-            self.session_expire = expire
-            Session.__init__(self, sid, refresh_time=refresh_time)
-
-        def _check_conn(self):
-            if not self.conn:
-                self.conn = redis.Redis(**self.redis_conf)
-
-        def _load(self):
-            self._check_conn()
-            v = self.conn.get(self.sid)
-            # if not v:
-            #    raise SessionError('sid %s not have value' % self.sid)
-            if v:
-                self.data.update(json.loads(v.decode('utf-8')))
-
-        def save(self):
-            if not self.data:
-                return
-            v = json.dumps(self.data)
-
-            self._check_conn()
-            self.conn.set(self.sid, v, self.session_expire)
-
-            self._update_refresh_cache()
-
-        def remove(self):
-            self._check_conn()
-            self.conn.delete(self.sid)
-
-        def refresh(self):
-            if self._check_refresh():
-                log.debug('refresh expire %s', self.sid)
-                self._check_conn()
-                self.conn.expire(self.sid, self.session_expire)
-
-
-    class SessionUser(Session):
-        def __init__(self, sid=None, expire=3600, config=None):
-            self.redis_conf = config.get('redis_conf')
-            self.sid = sid
-            self.user_key = config.get('user_key', 'userid')
-            self.expire = expire
-            self.conn = None
-            self.userid = 0
-            Session.__init__(self, sid, expire)
-
-        def _load(self):
+class SessionRedis(Session):
+    def __init__(self, sid=None, expire=3600, config=None):
+        self.redis_conf = config.get('redis_conf')
+        self.conn = None
+        refresh_time = config.get('refresh_time', 300)
+        self.session_expire = expire
+        # 读的时候用GETEX同时刷新过期时间(redis>=6.2), 不用再单独刷新
+        self.getex = config.get('getex', False)
+        self._refreshed = False
+        Session.__init__(self, sid, refresh_time=refresh_time)
+
+    def db(self):
+        if not self.conn:
+            self.conn = get_redis(self.redis_conf)
+        return self.conn
+
+    def _load(self):
+        if self.getex:
+            v = self.db().getex(self.sid, ex=self.session_expire)
+            self._refreshed = True
+        else:
             v = self.db().get(self.sid)
-            if v:
-                self.data.update(json.loads(v.decode('utf-8')))
-                self.userid = self.data.get(self.user_key, 0)
+        # if not v:
+        #    raise SessionError('sid %s not have value' % self.sid)
+        if v:
+            self._orig = v
+            self.data.update(codec.loads(v))
 
-        def is_login(self):
-            return self.userid > 0
+    def save(self):
+        if not self.data:
+            return
+        v = codec.dumps(self.data)
+        self.db().set(self.sid, v, ex=self.session_expire)
+        self._orig = v
 
-        def zkey(self, userid=None):
-            return 'zses.%s.%s' % (self.user_key, userid or self.data.get(self.user_key, ''))
+        self._update_refresh_cache()
 
-        def save(self):
-            if not self.data or self.user_key not in self.data:
-                return
+    def remove(self):
+        self.db().delete(self.sid)
 
-            self.db().set(self.sid, json.dumps(self.data), self.expire)
+    def refresh(self):
+        if self._refreshed:
+            return
+        if self._check_refresh():
+            log.debug('refresh expire %s', self.sid)
+            self.db().expire(self.sid, self.session_expire)
 
-            now = time.time()
-            self.db().zadd(self.zkey(), {self.sid: now + self.expire})
-            self.db().zremrangebyscore(self.zkey(), '-inf', now)
-            self.db().expire(self.zkey(), self.expire * 2)
 
-        def db(self):
-            if not self.conn:
-                self.conn = redis.Redis(**self.redis_conf)
-            return self.conn
+class SessionUser(Session):
+    def __init__(self, sid=None, expire=3600, config=None):
+        self.redis_conf = config.get('redis_conf')
+        self.sid = sid
+        self.user_key = config.get('user_key', 'userid')
+        self.expire = expire
+        self.conn = None
+        self.getex = config.get('getex', False)
+        self._refreshed = False
+        Session.__init__(self, sid, expire, config.get('refresh_time', 300))
 
-        def refresh(self):
-            self.db().expire(self.zkey(), self.expire * 2)
-            self.db().expire(self.sid, self.expire)
+    def _load(self):
+        if self.getex:
+            v = self.db().getex(self.sid, ex=self.expire)
+            self._refreshed = True
+        else:
+            v = self.db().get(self.sid)
+        if v:
+            self._orig = v
+            self.data.update(codec.loads(v))
 
-        def remove(self):
-            self.db().delete(self.sid)
-            self.db().zrem(self.zkey(), self.sid)
+    @property
+    def userid(self):
+        return self.data.get(self.user_key, 0)
 
-        def kickoff(self, userid=None, keep_length=0):
-            keys = self.db().zrange(self.zkey(userid), 0, -keep_length - 1)
-            if keys:
-                self.db().delete(*keys)
-                self.db().zrem(self.zkey(userid), *keys)
+    def is_login(self):
+        return self.userid > 0
 
+    def zkey(self, userid=None):
+        return 'zses.%s.%s' % (self.user_key, userid or self.data.get(self.user_key, ''))
 
-except:
-    pass
+    def save(self):
+        if not self.data or self.user_key not in self.data:
+            return
+
+        # 一次请求的写操作放在一个pipeline里
+        v = codec.dumps(self.data)
+        now = time.time()
+        zkey = self.zkey()
+        pipe = self.db().pipeline(transaction=False)
+        pipe.set(self.sid, v, ex=self.expire)
+        pipe.zadd(zkey, {self.sid: now + self.expire})
+        pipe.zremrangebyscore(zkey, '-inf', now)
+        pipe.expire(zkey, self.expire * 2)
+        pipe.execute()
+        self._orig = v
+
+        self._update_refresh_cache()
+
+    def db(self):
+        if not self.conn:
+            self.conn = get_redis(self.redis_conf)
+        return self.conn
+
+    def refresh(self):
+        if not self._check_refresh():
+            return
+        if self._refreshed:
+            # sid已经在读的时候刷新了, 只刷新用户的session列表
+            self.db().expire(self.zkey(), self.expire * 2)
+            return
+        pipe = self.db().pipeline(transaction=False)
+        pipe.expire(self.zkey(), self.expire * 2)
+        pipe.expire(self.sid, self.expire)
+        pipe.execute()
+
+    def remove(self):
+        pipe = self.db().pipeline(transaction=False)
+        pipe.delete(self.sid)
+        pipe.zrem(self.zkey(), self.sid)
+        pipe.execute()
+
+    def kickoff(self, userid=None, keep_length=0):
+        keys = self.db().zrange(self.zkey(userid), 0, -keep_length - 1)
+        if keys:
+            pipe = self.db().pipeline(transaction=False)
+            pipe.delete(*keys)
+            pipe.zrem(self.zkey(userid), *keys)
+            pipe.execute()
 
 
 def bkdrhash(a):
@@ -251,20 +313,21 @@ class SessionFile(Session):
             self.filename = '%s/ses%02d/%s' % (self.dirname, bkdrhash(self.sid) % 100, self.sid)
 
         if os.path.isfile(self.filename):
-            self.data = json.loads(open(self.filename).read())
+            with open(self.filename, 'rb') as f:
+                self.data = codec.loads(f.read())
             # log.debug('open data file:%s, %s', self.filename, self.data)
 
     def save(self):
         if not self.data:
             return
-        v = json.dumps(self.data)
+        v = codec.dumps(self.data)
         filepath = os.path.dirname(self.filename)
         if not os.path.isdir(filepath):
             os.makedirs(filepath)
 
         with open(self.filename, 'wb') as f:
             # log.debug('save ses: %s', self.filename)
-            f.write(v.encode('utf-8'))
+            f.write(v)
 
     def remove(self):
         if os.path.isfile(self.filename):
@@ -398,6 +461,153 @@ def test6():
     print(ses2.data)
 
 
+class FakeRedis(object):
+    '''测试用的redis, 记录请求次数, pipeline算一次'''
+    def __init__(self):
+        self.data = {}
+        self.ttl = {}
+        self.calls = 0
+
+    def _run(self, cmd, *args, **kwargs):
+        if cmd == 'get':
+            return self.data.get(args[0])
+        elif cmd == 'getex':
+            if args[0] in self.data:
+                self.ttl[args[0]] = kwargs.get('ex')
+            return self.data.get(args[0])
+        elif cmd == 'set':
+            self.data[args[0]] = args[1]
+            self.ttl[args[0]] = kwargs.get('ex')
+        elif cmd == 'expire':
+            if args[0] in self.data:
+                self.ttl[args[0]] = args[1]
+        elif cmd == 'delete':
+            for k in args:
+                self.data.pop(k, None)
+        elif cmd == 'zadd':
+            self.data.setdefault(args[0], {}).update(args[1])
+        elif cmd == 'zrem':
+            for k in args[1:]:
+                self.data.get(args[0], {}).pop(k, None)
+        elif cmd == 'zremrangebyscore':
+            z = self.data.get(args[0], {})
+            for k in [k for k, v in z.items() if v <= time.time()]:
+                z.pop(k)
+
+    def __getattr__(self, cmd):
+        def f(*args, **kwargs):
+            self.calls += 1
+            return self._run(cmd, *args, **kwargs)
+        return f
+
+    def pipeline(self, transaction=True):
+        r = self
+        cmds = []
+
+        class Pipeline:
+            def __getattr__(self, cmd):
+                return lambda *args, **kwargs: cmds.append((cmd, args, kwargs))
+
+            def execute(self):
+                r.calls += 1
+                return [r._run(c, *a, **kw) for c, a, kw in cmds]
+        return Pipeline()
+
+
+def test_pipeline():
+    conf = {'store': 'SessionUser', 'expire': 3600,
+            'config': {'redis_conf': {'host': 'fake'}, 'user_key': 'userid'}}
+    r = redis_conns[repr(sorted(conf['config']['redis_conf'].items()))] = FakeRedis()
+
+    x = create(conf)
+    x['userid'] = 1
+    x['name'] = 'zbase3'
+    assert x.auto_save() and r.calls == 1
+    assert r.ttl[x.sid] == 3600 and x.sid in r.data[x.zkey()]
+
+    # 没有读session不加载
+    r.calls = 0
+    x2 = create(conf, x.sid)
+    assert x2.auto_save() and r.calls == 0
+
+    # 读了没有修改, 不写
+    x2 = create(conf, x.sid)
+    assert x2.userid == 1 and x2.is_login() and r.calls == 1
+    x2['name'] = 'zbase3'
+    assert x2.auto_save() and r.calls == 1
+
+    # 修改了里面的数据也能发现
+    x2 = create(conf, x.sid)
+    x2['name'] = 'new'
+    x2.data.setdefault('tags', []).append('a')
+    assert x2.auto_save() and r.calls == 3
+    assert codec.loads(r.data[x.sid])['tags'] == ['a']
+
+    x2 = create(conf, x.sid)
+    x2.clear()
+    assert not x2.auto_save() and x.sid not in r.data
+    print('pipeline ok')
+
+
+def test_handler_finish():
+    '''通过web框架的Handler.finish保存session, 没有读过的session不加载'''
+    from zbase3.web import core
+    from zbase3.web.httpcore import Request
+
+    class App:
+        class settings:
+            SESSION = {'store': 'SessionUser', 'expire': 3600, 'cookie_name': 'sid',
+                       'config': {'redis_conf': {'host': 'fake3'}, 'user_key': 'userid'}}
+
+    r = redis_conns[repr(sorted(App.settings.SESSION['config']['redis_conf'].items()))] = FakeRedis()
+    h = core.Handler(App, Request({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/'}))
+    h.ses['userid'] = 1
+    h.finish()
+    sid = h.ses.sid
+    assert r.calls == 1 and sid in r.data
+
+    r.calls = 0
+    h = core.Handler(App, Request({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/', 'HTTP_COOKIE': 'sid=' + sid}))
+    assert h.ses
+    h.finish()
+    assert not h.ses._loaded and r.calls == 0
+
+    h = core.Handler(App, Request({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/', 'HTTP_COOKIE': 'sid=' + sid}))
+    assert h.ses.userid == 1
+    h.finish()
+    assert r.calls == 1
+    print('handler finish ok')
+
+
+def test_refresh_cache():
+    c = RefreshCache(maxsize=100, ttl=60)
+    now = time.time()
+    assert c.check('s1', 10, now) and not c.check('s1', 10, now + 5) and c.check('s1', 10, now + 11)
+    for i in range(1000):
+        c.update('s%d' % i, now + 20)
+    # 条数固定
+    assert len(c) == 100 and not c.check('s999', 10, now + 21)
+    # 超过ttl的删掉
+    c.update('x', now + 100)
+    assert len(c) == 1
+
+    conf = {'store': 'SessionRedis', 'expire': 3600,
+            'config': {'redis_conf': {'host': 'fake2'}, 'getex': True}}
+    r = redis_conns[repr(sorted(conf['config']['redis_conf'].items()))] = FakeRedis()
+    x = create(conf)
+    x['name'] = 'zbase3'
+    x.auto_save()
+    r.ttl[x.sid] = 10
+
+    # 读的时候刷新了过期时间, 不用再expire
+    session_refresh._cache.clear()
+    r.calls = 0
+    x2 = create(conf, x.sid)
+    assert x2['name'] == 'zbase3' and x2.auto_save()
+    assert r.calls == 1 and r.ttl[x.sid] == 3600
+    print('refresh cache ok')
+
+
 if __name__ == '__main__':
     # test4()
     # test5()
@@ -0,0 +1,296 @@
+# coding: utf-8
+import os
+import stat
+import time
+import mimetypes
+import threading
+import logging
+import calendar
+from email.utils import parsedate
+from collections import OrderedDict
+from zbase3.web.httpcore import Response, FileResponse, NotFound
+
+log = logging.getLogger()
+
+# 预压缩文件的后缀, 按优先级排列
+PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))
+
+
+def parse_accept_encoding(value):
+    '''解析Accept-Encoding, 返回 {编码: q值}'''
+    ret = {}
+    for item in value.split(','):
+        parts = item.split(';')
+        enc = parts[0].strip().lower()
+        if not enc:
+            continue
+        q = 1.0
+        for p in parts[1:]:
+            k, _, v = p.partition('=')
+            if k.strip().lower() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        ret[enc] = q
+    return ret
+
+
+class FileInfo (object):
+    def __init__(self, fpath, st):
+        self.fpath = fpath
+        self.mtime = st.st_mtime
+        self.mtime_ns = st.st_mtime_ns
+        self.size = st.st_size
+        self.checked = time.time()
+
+        mtype, encoding = mimetypes.guess_type(fpath)
+        if not mtype:
+            mtype = 'application/octet-stream'
+        self.mimetype = mtype
+        self.gmt = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(self.mtime))
+        self.etag = '"%x-%x"' % (self.mtime_ns, self.size)
+
+        # 预压缩的文件 {encoding: (path, size)}, 比原文件旧的不用
+        self.compressed = {}
+        for enc, ext in PRECOMPRESSED:
+            try:
+                cst = os.stat(fpath + ext)
+            except OSError:
+                continue
+            if cst.st_mtime >= self.mtime:
+                self.compressed[enc] = (fpath + ext, cst.st_size)
+
+    def etag_for(self, enc):
+        '''每种编码的内容不同, ETag也要不同'''
+        if not enc:
+            return self.etag
+        return '%s-%s"' % (self.etag[:-1], enc)
+
+
+class StaticFiles (object):
+    '''静态文件处理, 文件的stat和mimetype放在LRU缓存里，check_interval秒内不重复检查文件是否修改'''
+    def __init__(self, maxsize=1024, check_interval=1):
+        self.maxsize = maxsize
+        self.check_interval = check_interval
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _stat(self, fpath):
+        '''返回文件信息，文件不存在返回None'''
+        now = time.time()
+        with self._lock:
+            info = self._cache.get(fpath)
+            if info is not None:
+                self._cache.move_to_end(fpath)
+                if now - info.checked < self.check_interval:
+                    return info
+
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            st = None
+
+        with self._lock:
+            if st is None or not stat.S_ISREG(st.st_mode):
+                self._cache.pop(fpath, None)
+                return None
+            if info is not None and info.mtime_ns == st.st_mtime_ns and info.size == st.st_size:
+                info.checked = now
+                return info
+            info = FileInfo(fpath, st)
+            self._cache[fpath] = info
+            self._cache.move_to_end(fpath)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return info
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def choose_encoding(self, req, info):
+        '''按客户端的Accept-Encoding选择预压缩的文件, 没有可用的返回None'''
+        if not info.compressed:
+            return None
+        accept = parse_accept_encoding(req.environ.get('HTTP_ACCEPT_ENCODING', ''))
+        best, bestq = None, 0
+        for enc, ext in PRECOMPRESSED:
+            if enc not in info.compressed:
+                continue
+            q = accept.get(enc, accept.get('*', 0))
+            if q > bestq:
+                best, bestq = enc, q
+        return best
+
+    def not_modified(self, req, info, enc=None):
+        etags = req.environ.get('HTTP_IF_NONE_MATCH')
+        if etags:
+            if etags.strip() == '*':
+                return True
+            # If-None-Match 使用弱比较
+            etag = info.etag_for(enc)
+            return etag in [x.strip().replace('W/', '', 1) for x in etags.split(',')]
+
+        reqgmt = req.environ.get('HTTP_IF_MODIFIED_SINCE')
+        if not reqgmt:
+            return False
+        if reqgmt == info.gmt:
+            return True
+        t = parsedate(reqgmt)
+        if not t:
+            return False
+        return int(info.mtime) <= calendar.timegm(t)
+
+    def parse_range(self, req, info):
+        '''返回 (offset, length), 不是Range请求或者Range格式不对(忽略Range)返回None,
+        开始位置超出文件返回 (-1, 0)'''
+        rng = req.environ.get('HTTP_RANGE', '')
+        if not rng.startswith('bytes='):
+            return None
+
+        # If-Range 不匹配时返回整个文件
+        ifrange = req.environ.get('HTTP_IF_RANGE')
+        if ifrange and ifrange != info.etag and ifrange != info.gmt:
+            return None
+
+        spec = rng[6:].strip()
+        # 多个区间的不支持，返回整个文件
+        if ',' in spec or '-' not in spec:
+            return None
+
+        start, end = spec.split('-', 1)
+        try:
+            if not start:
+                n = int(end)
+                if n <= 0:
+                    return -1, 0
+                start = max(info.size - n, 0)
+                end = info.size - 1
+            else:
+                start = int(start)
+                end = int(end) if end else info.size - 1
+                end = min(end, info.size - 1)
+        except ValueError:
+            return None
+
+        if start >= info.size:
+            return -1, 0
+        # RFC 7233: 结束位置小于开始位置的Range无效, 忽略
+        if start > end:
+            return None
+        return start, end - start + 1
+
+    def __call__(self, req, fpath):
+        info = self._stat(fpath)
+        if info is None:
+            return NotFound('Not Found')
+
+        mtype = info.mimetype
+        enc = self.choose_encoding(req, info)
+        # 原来的逻辑: 未知类型的文件都直接下载，不返回304
+        if mtype != 'application/octet-stream' and self.not_modified(req, info, enc):
+            resp = Response('', status=304, mimetype=mtype)
+            resp.headers['Last-Modified'] = info.gmt
+            resp.headers['ETag'] = info.etag_for(enc)
+            if info.compressed:
+                resp.headers['Vary'] = 'Accept-Encoding'
+            return resp
+
+        rng = self.parse_range(req, info)
+        if rng is not None:
+            # 区间请求返回原文件
+            enc = None
+            offset, length = rng
+            if offset < 0:
+                resp = Response('', status=416, mimetype=mtype)
+                resp.headers['Content-Range'] = 'bytes */%d' % info.size
+                return resp
+            resp = FileResponse(info.fpath, offset, length, 206, mimetype=mtype)
+            resp.headers['Content-Range'] = 'bytes %d-%d/%d' % (offset, offset + length - 1, info.size)
+        else:
+            if enc:
+                cpath, csize = info.compressed[enc]
+                resp = FileResponse(cpath, 0, csize, 200, mimetype=mtype)
+                resp.headers['Content-Encoding'] = enc
+            else:
+                resp = FileResponse(info.fpath, 0, info.size, 200, mimetype=mtype)
+
+        if info.compressed:
+            resp.headers['Vary'] = 'Accept-Encoding'
+        resp.headers['Accept-Ranges'] = 'bytes'
+        resp.headers['Last-Modified'] = info.gmt
+        resp.headers['ETag'] = info.etag_for(enc)
+        return resp
+
+
+def test_static():
+    import tempfile
+
+    class Req:
+        def __init__(self, **env):
+            self.environ = env
+
+    d = tempfile.mkdtemp()
+    fpath = os.path.join(d, 'a.js')
+    with open(fpath, 'wb') as f:
+        f.write(b'0123456789')
+
+    sf = StaticFiles()
+    resp = sf(Req(), fpath)
+    assert resp.status == 200 and resp.length() == 10
+
+    resp2 = sf(Req(HTTP_IF_NONE_MATCH=resp.headers['ETag']), fpath)
+    assert resp2.status == 304
+
+    resp2 = sf(Req(HTTP_IF_MODIFIED_SINCE=resp.headers['Last-Modified']), fpath)
+    assert resp2.status == 304
+
+    resp2 = sf(Req(HTTP_RANGE='bytes=2-5'), fpath)
+    assert resp2.status == 206 and resp2.offset == 2 and resp2.length() == 4
+    assert resp2.headers['Content-Range'] == 'bytes 2-5/10'
+
+    resp2 = sf(Req(HTTP_RANGE='bytes=-3'), fpath)
+    assert resp2.offset == 7 and resp2.length() == 3
+
+    resp2 = sf(Req(HTTP_RANGE='bytes=20-'), fpath)
+    assert resp2.status == 416
+    # 格式不对的Range忽略, 返回整个文件
+    resp2 = sf(Req(HTTP_RANGE='bytes=5-2'), fpath)
+    assert resp2.status == 200 and resp2.length() == 10
+
+    with open(fpath + '.gz', 'wb') as f:
+        f.write(b'gz')
+    sf.clear()
+    resp2 = sf(Req(HTTP_ACCEPT_ENCODING='gzip, deflate'), fpath)
+    assert resp2.headers['Content-Encoding'] == 'gzip' and resp2.length() == 2
+    # 压缩的内容有自己的ETag
+    gzetag = resp2.headers['ETag']
+    assert gzetag != resp.headers['ETag'] and gzetag.endswith('-gzip"')
+
+    # q=0 表示不接受, 不是子串匹配
+    for accept in ('gzip;q=0, deflate', 'x-gzip-like', 'identity', ''):
+        resp3 = sf(Req(HTTP_ACCEPT_ENCODING=accept), fpath)
+        assert 'Content-Encoding' not in resp3.headers and resp3.headers['ETag'] == resp.headers['ETag'], accept
+        assert resp3.headers['Vary'] == 'Accept-Encoding'
+    assert sf(Req(HTTP_ACCEPT_ENCODING='*'), fpath).headers['Content-Encoding'] == 'gzip'
+
+    resp3 = sf(Req(HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=gzetag), fpath)
+    assert resp3.status == 304 and resp3.headers['ETag'] == gzetag and resp3.headers['Vary'] == 'Accept-Encoding'
+    # 原文件的ETag不能匹配压缩的内容
+    assert sf(Req(HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=resp.headers['ETag']), fpath).status == 200
+    resp3 = sf(Req(HTTP_IF_NONE_MATCH='W/' + resp.headers['ETag']), fpath)
+    assert resp3.status == 304 and resp3.headers['Vary'] == 'Accept-Encoding'
+
+    # If-Range 用压缩内容的ETag时返回整个原文件
+    resp3 = sf(Req(HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE=gzetag), fpath)
+    assert resp3.status == 200 and resp3.length() == 10
+    resp3 = sf(Req(HTTP_RANGE='bytes=2-5', HTTP_ACCEPT_ENCODING='gzip'), fpath)
+    assert resp3.status == 206 and resp3.headers['Vary'] == 'Accept-Encoding'
+
+    assert sf(Req(), fpath + '.no').status == 404
+    print('ok')
+
+
+if __name__ == '__main__':
+    test_static()
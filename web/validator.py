@@ -1,9 +1,12 @@
 # coding: utf-8
+import copy
 import functools
 import inspect
 import logging
 import re
+import time
 import traceback
+from collections import namedtuple
 
 from zbase3.base.excepts import ParamError
 from zbase3.web.core import HandlerFinish
@@ -86,106 +89,182 @@ class ValidatorError(Exception):
     pass
 
 
-class Validator:
-    def __init__(self, fields=None):
-        # fields must have must,type,match,name
-        self._fields = []
-        for f in fields:
-            if isinstance(f, str):
-                self._fields.append(Field(name=f))
-            else:
-                self._fields.append(f)
+def _matcher(name, match):
+    def check(val):
+        if not match.match(val):
+            log.debug('validator match error: %s, %s=%s', match.pattern, name, str(val))
+            raise ValidatorError(name)
+        return val
+    return check
+
+
+def _no_match(name):
+    def check(val):
+        raise ValidatorError('%s has no match pattern' % name)
+    return check
+
+
+def compile_field(field):
+    '''把字段编译为转换函数, 转换失败抛出ValidatorError或者ValueError'''
+    name = field.name.split('__')[0]
+    if field.type == T_MUST:
+        conv = None
+    elif field.type & T_INT:
+        conv = int
+    elif field.type & T_FLOAT:
+        conv = float
+    elif field.type & T_STR:
+        conv = _matcher(name, field.match) if field.match else None
+    elif field.match:
+        conv = _matcher(name, field.match)
+    else:
+        conv = _no_match(name)
+
+    # 枚举值校验 只处理STR FLOAT INT
+    if field.type > T_STR or not field.choice:
+        return conv or (lambda val: val)
+
+    try:
+        choice = frozenset(field.choice)
+    except TypeError:
+        choice = tuple(field.choice)
+    choice_str = ','.join(map(str, field.choice))
+
+    def check(val):
+        ret = conv(val) if conv else val
+        if ret not in choice:
+            raise ValidatorError('validator choice error: {}:{} not in {}'.format(name, val, choice_str))
+        return ret
+    return check
 
-        self.data = {}
 
-    def _check_item(self, field, val):
-        if field.type == T_MUST:
-            ret = val
-        elif field.type & T_INT:
-            ret = int(val)
-        elif field.type & T_FLOAT:
-            ret = float(val)
-        elif field.type & T_STR:
-            if field.match:
-                if not field.match.match(val):
-                    log.debug('validator match error: %s, %s=%s', field.match.pattern, field.name, str(val))
-                    raise ValidatorError(field.name)
-            ret = val
-        else:
-            if not field.match.match(val):
-                log.debug('validator match error: %s, %s=%s', field.match.pattern, field.name, str(val))
-                raise ValidatorError(field.name)
-            ret = val
+# 编译后的一个字段
+Rule = namedtuple('Rule', 'name must default convert')
 
-        # 枚举值校验 只处理STR FLOAT INT
-        if field.type <= T_STR and field.choice:
-            if ret not in field.choice:
-                choice = ','.join(map(str, field.choice))
-                raise ValidatorError('validator choice error: {}:{} not in {}'.format(field.name, val, choice))
 
-        return ret
+class VerifyResult:
+    '''一次校验的结果, errors为没验证通过的字段名'''
+    __slots__ = ('errors', 'data', 'ops')
 
-    def verify(self, inputdata):
-        result = []  # 没验证通过的字段名
+    def __init__(self):
+        self.errors = []
+        self.data = {}
+        # 字段的操作符 {name: op}
+        self.ops = {}
+
+    def __bool__(self):
+        return not self.errors
+
+
+class ValidatorPlan:
+    '''字段列表编译后的校验计划, 编译后不再修改, 可以在多个线程/协程里共用'''
+    def __init__(self, fields=None):
+        self.fields = tuple(Field(name=f) if isinstance(f, str) else f for f in fields or [])
+        self.rules = tuple(Rule(f.name.split('__')[0], f.must, f.default, compile_field(f))
+                           for f in self.fields)
 
-        # check input format and transfer to {key: [op, value]}
-        _input = {}
+    def _split_ops(self, inputdata, errors):
+        '''name__op=value 转换为 {name: (op, value)}, 不支持的op记录在errors里'''
+        ops = {}
         for k, v in inputdata.items():
             if '__' in k:
-                k_name, k_op = k.split('__')
+                k_name, k_op = k.split('__', 1)
                 op = opmap.get(k_op)
                 if not op:  # k_name error
-                    result.append(k_name)
+                    errors.append(k_name)
                     continue
-                _input[k_name] = [op, v]
-            else:
-                _input[k] = ['=', v]
-
-        if result:
+                ops[k_name] = (op, v)
+            elif ops:
+                # 后出现的同名参数优先
+                ops.pop(k, None)
+        return ops
+
+    def check(self, inputdata):
+        result = VerifyResult()
+        errors = result.errors
+        data = result.data
+
+        ops = self._split_ops(inputdata, errors)
+        if errors:
             return result
 
-        # check field and transfer type
-        for f in self._fields:
-            try:
-                f.name = f.name.split('__')[0]
-                val = _input.get(f.name)
-                if not val:  # field defined not exist
-                    if f.must:  # null is not allowed, error
-                        result.append(f.name)
-                    elif not f.default is None:
-                        f.value = f.default
-                        self.data[f.name] = f.default
-                    continue
+        for name, must, default, convert in self.rules:
+            if name in ops:
+                op, v = ops[name]
+            elif name in inputdata:
+                op, v = '=', inputdata[name]
+            else:  # field defined not exist
+                if must:  # null is not allowed, error
+                    errors.append(name)
+                elif default is not None:
+                    data[name] = default
+                    result.ops[name] = '='
+                continue
 
-                f.op = val[0]
-                v = val[1]
-                if val[0] != '=':
+            try:
+                if op != '=':
                     d = v if ',' not in v else v.split(',')
                     if isinstance(d, list):
-                        f.value = [self._check_item(f, cv) for cv in d]
+                        value = [convert(cv) for cv in d]
                     else:
-                        f.value = self._check_item(f, d)
-                    if not f.value:
-                        result.append(f.name)
+                        value = convert(d)
+                    if not value:
+                        errors.append(name)
+                    data[name] = (op, value)
                 else:
-                    f.value = self._check_item(f, v)
-                    if f.value is None:
-                        result.append(f.name)
-                if f.op == '=':
-                    self.data[f.name] = f.value
-                else:
-                    self.data[f.name] = (f.op, f.value)
-            except ValidatorError:
-                result.append(f.name)
-                log.warn(traceback.format_exc())
+                    value = convert(v)
+                    if value is None:
+                        errors.append(name)
+                    data[name] = value
+                result.ops[name] = op
+            except ValidatorError as e:
+                errors.append(name)
+                log.warning('validator error: %s', e)
             except ValueError:
-                result.append(f.name)
+                errors.append(name)
             except:
-                result.append(f.name)
+                errors.append(name)
                 log.info(traceback.format_exc())
         return result
 
-    def report(self, result, sep=u'<br/>'):
+
+class Validator:
+    def __init__(self, fields=None):
+        # fields must have must,type,match,name
+        if isinstance(fields, ValidatorPlan):
+            self.plan = fields
+        else:
+            self.plan = ValidatorPlan(fields)
+
+        self.data = {}
+        self.result = None
+        self._bound = None
+
+    def verify(self, inputdata):
+        '''返回没验证通过的字段名, 转换后的值在self.data里'''
+        self.result = self.plan.check(inputdata)
+        self.data = self.result.data
+        self._bound = None
+        return self.result.errors
+
+    @property
+    def _fields(self):
+        '''带这次校验的value/op的字段副本, 给 fields2where 等用. 计划里的字段不修改'''
+        if self._bound is None:
+            ops = self.result.ops if self.result else {}
+            fields = []
+            for f in self.plan.fields:
+                f = copy.copy(f)
+                f.name = f.name.split('__')[0]
+                f.op = ops.get(f.name, '=')
+                v = self.data.get(f.name)
+                f.value = v[1] if f.op != '=' else v
+                fields.append(f)
+            self._bound = fields
+        return self._bound
+
+    @staticmethod
+    def report(result, sep=u'<br/>'):
         ret = []
         for x in result:
             if x:
@@ -194,9 +273,11 @@ class Validator:
 
 
 def with_validator(fields):
+    plan = ValidatorPlan(fields)
+
     def f(func):
         def _(self, *args, **kwargs):
-            vdt = Validator(fields)
+            vdt = Validator(plan)
             self.validator = vdt
 
             if hasattr(self, 'input'):
@@ -223,9 +304,25 @@ def with_validator(fields):
     return f
 
 
+# with_validator_self 的校验计划 {(cls, fields_name): (fields, ValidatorPlan)}
+_self_plans = {}
+
+
 def with_validator_self(func):
+    fields_name = '%s_fields' % func.__name__
+
     def _(self, *args, **kwargs):
-        vdt = Validator(getattr(self, '%s_fields' % func.__name__))
+        fields = getattr(self, fields_name)
+        key = (self.__class__, fields_name)
+        item = _self_plans.get(key)
+        if item is not None and item[0] is fields:
+            plan = item[1]
+        else:
+            plan = ValidatorPlan(fields)
+            # 实例上运行时改过的字段每次编译, 只缓存类上定义的
+            if fields is getattr(self.__class__, fields_name, None):
+                _self_plans[key] = (fields, plan)
+        vdt = Validator(plan)
         self.validator = vdt
         if hasattr(self, 'input'):
             ret = vdt.verify(self.input())
@@ -256,40 +353,47 @@ def is_args_kw(param):
     return param.kind in (inspect._VAR_POSITIONAL, inspect._VAR_KEYWORD)
 
 
+ANNO_TYPE_MAP = {int: T_INT, float: T_FLOAT, str: T_STR}
+
+
+def anno_fields(params):
+    '''根据函数参数的注解生成校验字段'''
+    check_fields = []
+    for key in params:
+        param = params[key]
+        anno = param.annotation
+        default = None if is_empty(param.default) else param.default
+        if isinstance(anno, Field):
+            check_fields.append(anno)
+        elif anno in ANNO_TYPE_MAP:
+            check_fields.append(Field(param.name, ANNO_TYPE_MAP[anno], default=default))
+        elif isinstance(anno, int):
+            check_fields.append(Field(
+                param.name, anno, must=is_empty(param.default), default=default
+            ))
+        elif not is_args_kw(param) and is_empty(anno) and is_empty(param.default):
+            check_fields.append(Field(param.name, valtype=T_MUST, must=True))
+    return check_fields
+
+
 def with_anno_check(func):
+    # 签名和校验字段只在装饰时生成一次
     params = inspect.signature(func).parameters
     names = tuple(name for name, param in params.items() if not is_args_kw(param))
+    plan = ValidatorPlan(anno_fields(params))
 
     @functools.wraps(func)
     def wrapper(*args, **kw):
         if len(args) > len(names):
             raise ParamError('params too many')
 
-        check_fields = []
         _input = {names[i]: v for i, v in enumerate(args)}
         _input.update(kw)
 
-        fields_map = {int: T_INT, float: T_FLOAT, str: T_STR}
-        for key in params:
-            param = params[key]
-            anno = param.annotation
-            default = None if is_empty(param.default) else param.default
-            if isinstance(anno, Field):
-                check_fields.append(anno)
-            elif anno in fields_map:
-                check_fields.append(Field(param.name, fields_map[anno], default=default))
-            elif isinstance(anno, int):
-                check_fields.append(Field(
-                    param.name, anno, must=is_empty(param.default), default=default
-                ))
-            elif not is_args_kw(param) and is_empty(anno) and is_empty(param.default):
-                check_fields.append(Field(param.name, valtype=T_MUST, must=True))
-
-        validator = Validator(check_fields)
-        ret = validator.verify(_input)
-        if ret:
-            raise ParamError(validator.report(ret))
-        _input.update(validator.data)
+        result = plan.check(_input)
+        if result.errors:
+            raise ParamError(Validator.report(result.errors))
+        _input.update(result.data)
 
         self = _input.get('self', None)
         if self:
@@ -299,7 +403,6 @@ def with_anno_check(func):
 
     return wrapper
 
-
 def test1():
     from zbase3.base import logger
     log = logger.install('stdout')
@@ -325,8 +428,9 @@ def test1():
     else:
         log.debug('check ok')
 
-    for f in x._fields:
-        log.debug('name:%s, value:%s, valuetype:%s, op:%s' % (f.name, f.value, type(f.value), f.op))
+    for name, op in x.result.ops.items():
+        value = x.data[name] if op == '=' else x.data[name][1]
+        log.debug('name:%s, value:%s, valuetype:%s, op:%s' % (name, value, type(value), op))
 
 
 def test2():
@@ -521,6 +625,63 @@ def test5():
     # test_fn2('nickname', 'age', '1.0', 2.0, 3.0, 4.0, 5.0)
 
 
+def test_plan():
+    fields = [Field('age', T_INT, must=True), Field('cate', T_INT), Field('name', choice=['a', 'b']),
+              Field('mail', T_MAIL), Field('rate', T_FLOAT, default=1.0)]
+    plan = ValidatorPlan(fields)
+    r = plan.check({'age': '12', 'cate__in': '1,2,3', 'name': 'a', 'mail': 'x@y.com'})
+    assert not r.errors, r.errors
+    assert r.data == {'age': 12, 'cate': ('in', [1, 2, 3]), 'name': 'a', 'mail': 'x@y.com', 'rate': 1.0}
+    assert r.ops['cate'] == 'in'
+
+    r = plan.check({'age': 'x', 'name': 'c', 'mail': 'bad'})
+    assert r.errors == ['age', 'name', 'mail'], r.errors
+    assert plan.check({'age': '1', 'cate__xx': '1'}).errors == ['cate']
+    # 字段没有被修改, 可以共用
+    assert all(f.value is None for f in fields)
+
+    v = Validator(fields)
+    assert v.verify({'age': '3'}) == [] and v.data == {'age': 3, 'rate': 1.0}
+
+    # with_validator_self: 实例上改过的字段不用类上缓存的计划
+    class Handler:
+        get_fields = [Field('age', T_INT)]
+        def __init__(self, data):
+            self.data = data
+        def input(self):
+            return self.data
+        @with_validator_self
+        def get(self):
+            return self.data
+
+    assert Handler({'age': '3'}).get() == {'age': 3}
+    h = Handler({'age': '3', 'name': 'x'})
+    h.get_fields = [Field('age', T_INT), Field('name')]
+    assert h.get() == {'age': 3, 'name': 'x'}
+    assert Handler({'age': '3', 'name': 'x'}).get() == {'age': 3}
+    print('ok')
+
+
+def test_perf(n=10000):
+    '''25个字段, 对比每次创建Validator和使用编译好的计划的耗时, 单位微秒'''
+    fields = []
+    data = {}
+    for i in range(25):
+        t = (T_INT, T_STR, T_FLOAT, T_MAIL, T_DATE)[i % 5]
+        fields.append(Field('f%d' % i, t, choice=['1', '2'] if i == 1 else None))
+        data['f%d' % i] = ('12', '1', '1.5', 'a@b.com', '2020-01-02')[i % 5]
+
+    start = time.time()
+    for i in range(n):
+        Validator(fields).verify(data)
+    t1 = time.time()
+    plan = ValidatorPlan(fields)
+    for i in range(n):
+        plan.check(data)
+    t2 = time.time()
+    print('fields:25 new validator:%.1f plan:%.1f' % ((t1 - start) / n * 1000000, (t2 - t1) / n * 1000000))
+
+
 if __name__ == '__main__':
     # test1()
     # test2()